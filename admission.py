@@ -0,0 +1,72 @@
+"""Admission control for styling requests
+
+Styling is far more expensive than anything else the server does, so a
+burst of requests is turned away early instead of being accepted and left
+to time out. The StyleJob queue is bounded in total depth and in how many
+jobs, and how many previews, one user may have in flight.
+
+Previews are queued too rather than rendered in the web process: they jump
+the queue (see StyleJob.claim_next) and the client polls for them. A
+preview therefore waits for a free worker thread, at worst as long as the
+shortest full render in progress, but web processes never import
+tensorflow or hold a style session.
+
+Saturated requests get a 429 whose Retry-After is estimated from the
+throughput actually observed.
+"""
+
+from math import ceil
+from os import environ
+
+from model import StyleJob
+
+MAX_PREVIEWS_PER_USER = 1
+MAX_QUEUED_JOBS = int(environ.get('DEEP_PAINT_MAX_QUEUED_JOBS', 64))
+MAX_JOBS_PER_USER = int(environ.get('DEEP_PAINT_MAX_JOBS_PER_USER', 3))
+# finished jobs in this window give the queue's throughput
+THROUGHPUT_WINDOW_SECONDS = 300
+# Retry-After bounds, the upper one also used before anything has finished
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 120
+
+
+class Saturated(Exception):
+    """Raised when a styling request cannot be admitted right now"""
+
+    def __init__(self, message, retry_after):
+        super(Saturated, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_after(seconds):
+    """Round an estimated wait up to whole seconds within the bounds"""
+    if seconds is None:
+        return MAX_RETRY_AFTER
+    return int(min(max(ceil(seconds), MIN_RETRY_AFTER), MAX_RETRY_AFTER))
+
+
+def check_job_queue(user_id=None, preview=False):
+    """Raise Saturated if the StyleJob queue, or this user's share, is full"""
+    queued = StyleJob.count_active()
+    if queued >= MAX_QUEUED_JOBS:
+        raise Saturated('the style queue is full',
+                        retry_after(estimate_job_wait(
+                            queued - MAX_QUEUED_JOBS + 1)))
+    if user_id is not None:
+        user_queued = StyleJob.count_active(user_id)
+        if user_queued >= MAX_JOBS_PER_USER:
+            raise Saturated('too many styles in progress',
+                            retry_after(estimate_job_wait(
+                                user_queued - MAX_JOBS_PER_USER + 1)))
+        if (preview and StyleJob.count_active(user_id, previews=True) >=
+                MAX_PREVIEWS_PER_USER):
+            raise Saturated('too many previews in progress',
+                            retry_after(estimate_job_wait(1)))
+
+
+def estimate_job_wait(jobs):
+    """Seconds for the workers to get through this many more jobs"""
+    throughput = StyleJob.get_throughput(THROUGHPUT_WINDOW_SECONDS)
+    if not throughput:
+        return None
+    return jobs / throughput
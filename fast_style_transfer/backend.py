@@ -0,0 +1,62 @@
+"""Lazily loaded inference backend
+
+Importing evaluate pulls in tensorflow, which takes seconds and hundreds of
+MB of RSS. Web processes that only serve feeds and likes never style an
+image, so model.py talks to inference through this interface instead and
+the backend module is imported the first time a style is actually run.
+worker.py loads it at startup so the first job does not pay for it.
+"""
+
+import importlib
+import os
+import threading
+
+# module providing ffwd_bytes and ffwd_many
+BACKEND_MODULE = os.environ.get('DEEP_PAINT_INFERENCE_BACKEND',
+                                'fast_style_transfer.evaluate')
+
+
+class InferenceBackend(object):
+    """Proxy to the inference functions of a module imported on first use"""
+
+    def __init__(self, module_name=BACKEND_MODULE):
+        self.module_name = module_name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<InferenceBackend module="{name}" loaded={loaded}>'.format(
+            name=self.module_name, loaded=self.is_loaded)
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    @property
+    def module(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self.module_name)
+        return self._module
+
+    def ffwd_bytes(self, *args, **kwargs):
+        """Style an in-memory image, see evaluate.ffwd_bytes"""
+        return self.module.ffwd_bytes(*args, **kwargs)
+
+    def ffwd_many(self, *args, **kwargs):
+        """Style one image with several checkpoints, see evaluate.ffwd_many"""
+        return self.module.ffwd_many(*args, **kwargs)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the process-wide InferenceBackend"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = InferenceBackend()
+        return _backend
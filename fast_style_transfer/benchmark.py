@@ -0,0 +1,198 @@
+"""Reproducible inference benchmarks for transform.net
+
+Every configuration runs in a fresh process against a randomly initialised
+checkpoint, so no trained style or GPU is needed and peak RSS is per
+configuration. Each network variant (see transform.VARIANTS) is measured
+and reported with its FLOPs per image. Results are printed as JSON; save
+them as a baseline and later runs can be compared against it:
+
+    $ python fast_style_transfer/benchmark.py --output baseline.json
+    $ python fast_style_transfer/benchmark.py --compare baseline.json
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+SIZES = [256, 512, 1024, 2048]
+VARIANTS = ['full', 'lite']
+BATCH_SIZES = [1, 4]
+THREADS = [1, multiprocessing.cpu_count()]
+RUNS = 5
+# steady state latency may grow this much over the baseline before a run is
+# reported as a regression
+TOLERANCE = 0.1
+
+
+# tensorflow is only imported in the child processes, so the parent never
+# forks while holding tensorflow's threads
+def _save_random_checkpoint(checkpoint_dir, variant):
+    import tensorflow as tf
+    import transform
+    from freeze import BATCH_SHAPE
+    with tf.Graph().as_default(), tf.Session() as sess:
+        transform.net(tf.placeholder(tf.float32, shape=BATCH_SHAPE),
+                      **transform.VARIANTS[variant])
+        sess.run(tf.global_variables_initializer())
+        return tf.train.Saver().save(
+            sess, '{dir}/{variant}.ckpt'.format(dir=checkpoint_dir,
+                                                variant=variant))
+
+
+def _run_config(checkpoint_path, variant, size, batch_size,
+                intra_op_threads, runs, device_t):
+    """Time one configuration, meant to run in its own process"""
+    import tensorflow as tf
+    import transform
+    from freeze import BATCH_SHAPE, restore
+
+    X = np.random.uniform(0, 255, (batch_size, size, size, 3)).astype(
+        np.float32)
+    config = tf.ConfigProto(allow_soft_placement=True,
+                            intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=1)
+    config.gpu_options.allow_growth = True
+
+    graph = tf.Graph()
+    start_time = time.time()
+    with graph.as_default(), graph.device(device_t):
+        img_placeholder = tf.placeholder(tf.float32, shape=BATCH_SHAPE,
+                                         name='img_placeholder')
+        preds = transform.net(img_placeholder, **transform.VARIANTS[variant])
+        saver = tf.train.Saver()
+    graph_build = time.time() - start_time
+
+    with tf.Session(graph=graph, config=config) as sess:
+        start_time = time.time()
+        restore(saver, sess, checkpoint_path)
+        restore_time = time.time() - start_time
+
+        start_time = time.time()
+        sess.run(preds, feed_dict={img_placeholder: X})
+        first_run = time.time() - start_time
+
+        latencies = []
+        for _ in range(runs):
+            start_time = time.time()
+            sess.run(preds, feed_dict={img_placeholder: X})
+            latencies.append(time.time() - start_time)
+
+    steady_state = float(np.median(latencies))
+    return {
+        'variant': variant,
+        'gflopsPerImage': transform.count_flops(
+            size, size, **transform.VARIANTS[variant]) / 1e9,
+        'size': size,
+        'batchSize': batch_size,
+        'intraOpThreads': intra_op_threads,
+        'graphBuildSec': graph_build,
+        'restoreSec': restore_time,
+        'firstRunSec': first_run,
+        'steadyStateSec': steady_state,
+        'imagesPerSec': batch_size / steady_state,
+        # ru_maxrss is in kilobytes on linux
+        'peakRssMb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+        1024.0,
+    }
+
+
+def _in_fresh_process(func, *args):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def benchmark(sizes=SIZES, batch_sizes=BATCH_SIZES, threads=THREADS,
+              runs=RUNS, device_t='/device:CPU:0', variants=VARIANTS):
+    """Sweep variant x resolution x batch size x intra-op threads"""
+    checkpoint_dir = tempfile.mkdtemp()
+    try:
+        results = []
+        for variant in variants:
+            checkpoint_path = _in_fresh_process(_save_random_checkpoint,
+                                                checkpoint_dir, variant)
+            for intra_op_threads in threads:
+                for size in sizes:
+                    for batch_size in batch_sizes:
+                        result = _in_fresh_process(
+                            _run_config, checkpoint_path, variant, size,
+                            batch_size, intra_op_threads, runs, device_t)
+                        print('{variant} {size}px x{batchSize} '
+                              '{intraOpThreads} threads: {imagesPerSec:.2f} '
+                              'images/sec'.format(**result), file=sys.stderr)
+                        results.append(result)
+    finally:
+        shutil.rmtree(checkpoint_dir)
+    return {'cores': multiprocessing.cpu_count(), 'device': device_t,
+            'runs': runs, 'results': results}
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    """Flag configurations whose steady state latency regressed
+
+    Configurations missing from the baseline are skipped.
+    """
+
+    def key(result):
+        return (result.get('variant', 'full'), result['size'],
+                result['batchSize'], result['intraOpThreads'])
+
+    baseline_results = dict((key(result), result)
+                            for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        before = baseline_results.get(key(result))
+        if before is None:
+            continue
+        change = result['steadyStateSec'] / before['steadyStateSec'] - 1
+        if change > tolerance:
+            regressions.append({
+                'variant': result['variant'],
+                'size': result['size'],
+                'batchSize': result['batchSize'],
+                'intraOpThreads': result['intraOpThreads'],
+                'baselineSec': before['steadyStateSec'],
+                'steadyStateSec': result['steadyStateSec'],
+                'change': change,
+            })
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--variants', nargs='+', default=VARIANTS)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=BATCH_SIZES)
+    parser.add_argument('--threads', type=int, nargs='+', default=THREADS,
+                        help='intra-op thread counts, 0 for all cores')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--device', default='/device:CPU:0')
+    parser.add_argument('--output', help='also write the JSON report here')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='flag regressions against a saved report')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    report = benchmark(args.sizes, args.batch_sizes, args.threads, args.runs,
+                       args.device, args.variants)
+    if args.compare:
+        with open(args.compare) as f:
+            report['regressions'] = compare(report, json.load(f),
+                                            args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if report.get('regressions'):
+        sys.exit(1)
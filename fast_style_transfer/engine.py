@@ -0,0 +1,315 @@
+"""Long-lived inference engine for transform.net checkpoints
+
+Building the transform graph, opening a session and restoring a checkpoint
+costs far more than a single forward pass, so the engine keeps restored
+sessions resident between calls. Each style checkpoint gets one session
+whose graph accepts any image size, the number of resident styles is
+bounded by an LRU policy, and evicting a style closes its session so
+TensorFlow can release its memory. Sessions are handed out as leases, and
+an evicted session that is still leased is only closed once its last
+lease is released.
+"""
+
+from __future__ import print_function
+import os
+import threading
+import numpy as np
+import tensorflow as tf
+import transform
+from collections import OrderedDict
+from metrics import Stats, register, stage_timer
+from freeze import (BATCH_SHAPE, get_frozen_path, has_fresh_frozen,
+                    load_frozen, restore)
+
+MAX_RESIDENT_STYLES = int(os.environ.get('DEEP_PAINT_MAX_STYLES', 3))
+# 0 lets tensorflow size its thread pools to every core on the machine
+INTRA_OP_THREADS = int(os.environ.get('DEEP_PAINT_INTRA_OP_THREADS', 0))
+INTER_OP_THREADS = int(os.environ.get('DEEP_PAINT_INTER_OP_THREADS', 0))
+USE_FROZEN = os.environ.get('DEEP_PAINT_USE_FROZEN', '1') == '1'
+
+
+class StyleSession(object):
+    """A restored transform.net graph for one style checkpoint
+
+    The placeholder has unknown batch, height and width so one session
+    serves every image size; only images within a single run must share a
+    shape. A current frozen graph (see freeze.py) is loaded in preference
+    to rebuilding the network and restoring the checkpoint.
+    """
+
+    def __init__(self, checkpoint_dir, device_t,
+                 intra_op_threads=INTRA_OP_THREADS,
+                 inter_op_threads=INTER_OP_THREADS):
+        self.checkpoint_dir = checkpoint_dir
+        self.device_t = device_t
+        self.graph = tf.Graph()
+        soft_config = tf.ConfigProto(
+            allow_soft_placement=True,
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads)
+        soft_config.gpu_options.allow_growth = True
+        self.is_frozen = USE_FROZEN and has_fresh_frozen(checkpoint_dir)
+        with self.graph.as_default(), self.graph.device(device_t):
+            if self.is_frozen:
+                with stage_timer('restore', checkpoint_dir):
+                    self.img_placeholder, self.preds = load_frozen(
+                        get_frozen_path(checkpoint_dir))
+                self.sess = tf.Session(config=soft_config)
+            else:
+                with stage_timer('graph_build', checkpoint_dir):
+                    self.img_placeholder = tf.placeholder(
+                        tf.float32, shape=BATCH_SHAPE,
+                        name='img_placeholder')
+                    self.preds = transform.net(
+                        self.img_placeholder,
+                        **transform.read_config(checkpoint_dir))
+                    saver = tf.train.Saver()
+                self.sess = tf.Session(config=soft_config)
+                with stage_timer('restore', checkpoint_dir):
+                    restore(saver, self.sess, checkpoint_dir)
+        self.graph.finalize()
+
+    def run(self, X):
+        with stage_timer('sess_run', self.checkpoint_dir, X.shape):
+            return self.sess.run(self.preds,
+                                 feed_dict={self.img_placeholder: X})
+
+    def close(self):
+        self.sess.close()
+        self.sess = None
+
+
+class SessionLease(object):
+    """A hold on a resident StyleSession, released when the caller is done
+
+    The session is not closed while any lease on it is held, even if the
+    engine evicts it in the meantime. Use it as a context manager or call
+    release().
+    """
+
+    def __init__(self, engine, style_session):
+        self.engine = engine
+        self.style_session = style_session
+        self.is_released = False
+
+    def __repr__(self):
+        return '<SessionLease checkpoint_dir="{dir}">'.format(
+            dir=self.style_session.checkpoint_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def run(self, X):
+        assert not self.is_released, 'lease has been released'
+        return self.style_session.run(X)
+
+    def release(self):
+        if not self.is_released:
+            self.is_released = True
+            self.engine._release(self.style_session)
+
+
+class InferenceEngine(object):
+    """LRU pool of restored style sessions, one per style checkpoint
+
+    Counters:
+        hits       lookups served by an already restored session
+        misses     lookups that had to build a graph and restore a checkpoint
+        evictions  styles dropped to stay within max_styles
+
+    intra_op_threads and inter_op_threads bound the tensorflow thread pools
+    of every session the engine creates.
+    """
+
+    def __init__(self, max_styles=MAX_RESIDENT_STYLES,
+                 intra_op_threads=INTRA_OP_THREADS,
+                 inter_op_threads=INTER_OP_THREADS):
+        assert max_styles > 0
+        self.max_styles = max_styles
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._styles = OrderedDict()
+        self._building = {}
+        # leases held per session, and evicted sessions still leased
+        self._users = {}
+        self._retired = set()
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return '<InferenceEngine resident={n} max_styles={max}>'.format(
+            n=len(self._styles), max=self.max_styles)
+
+    def get(self, checkpoint_dir, device_t='/device:CPU:0'):
+        """Lease the style's restored StyleSession, building it on a miss
+
+        Different styles are restored concurrently; callers racing on the
+        same cold style wait for a single restore. The returned
+        SessionLease must be released when the caller is done with it.
+        """
+        key = (checkpoint_dir, device_t)
+        with self._lock:
+            style_session = self._touch(key)
+            if style_session is not None:
+                self.hits += 1
+                return self._lease(style_session)
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                style_session = self._touch(key)
+                if style_session is not None:
+                    self.hits += 1
+                    return self._lease(style_session)
+                self.misses += 1
+
+            style_session = self._create_session(checkpoint_dir, device_t)
+            with self._lock:
+                self._styles[key] = style_session
+                self._building.pop(key, None)
+                # leased before eviction runs so it cannot close at once
+                lease = self._lease(style_session)
+                self._evict_overflow()
+            return lease
+
+    def run(self, checkpoint_dir, X, device_t='/device:CPU:0'):
+        """Run a batch through the style's resident session"""
+        with self.get(checkpoint_dir, device_t) as lease:
+            return lease.run(X)
+
+    def warm_up(self, checkpoint_dirs, sizes, device_t='/device:CPU:0'):
+        """Restore styles and run one dummy pass per size through each
+
+        checkpoint_dirs are in order of importance and only as many as fit
+        in max_styles are loaded, most important last so it is the last to
+        be evicted. Returns the checkpoints that were warmed.
+        """
+        checkpoint_dirs = list(checkpoint_dirs)[:self.max_styles]
+        for checkpoint_dir in reversed(checkpoint_dirs):
+            for size in sizes:
+                self.run(checkpoint_dir,
+                         np.zeros((1, size, size, 3), dtype=np.float32),
+                         device_t)
+        return checkpoint_dirs
+
+    def evict(self, checkpoint_dir=None):
+        """Drop one style (every device), or every style if none is given"""
+        with self._lock:
+            for key in list(self._styles):
+                if checkpoint_dir is None or key[0] == checkpoint_dir:
+                    self._retire(self._styles.pop(key))
+
+    def resize(self, max_styles):
+        assert max_styles > 0
+        with self._lock:
+            self.max_styles = max_styles
+            self._evict_overflow()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'resident': len(self._styles),
+                'retired': len(self._retired),
+                'maxStyles': self.max_styles,
+            }
+
+    def _create_session(self, checkpoint_dir, device_t):
+        return StyleSession(checkpoint_dir, device_t, self.intra_op_threads,
+                            self.inter_op_threads)
+
+    def _lease(self, style_session):
+        """Count a new user of a resident session, caller holds the lock"""
+        self._users[style_session] = self._users.get(style_session, 0) + 1
+        return SessionLease(self, style_session)
+
+    def _release(self, style_session):
+        with self._lock:
+            self._users[style_session] -= 1
+            if self._users[style_session]:
+                return
+            del self._users[style_session]
+            if style_session in self._retired:
+                self._retired.remove(style_session)
+                style_session.close()
+
+    def _retire(self, style_session):
+        """Close an evicted session now, or once its last lease is released"""
+        self.evictions += 1
+        if self._users.get(style_session):
+            self._retired.add(style_session)
+        else:
+            style_session.close()
+
+    def _touch(self, key):
+        """Mark a resident style as most recently used"""
+        style_session = self._styles.pop(key, None)
+        if style_session is not None:
+            self._styles[key] = style_session
+        return style_session
+
+    def _evict_overflow(self):
+        while len(self._styles) > self.max_styles:
+            _, style_session = self._styles.popitem(last=False)
+            self._retire(style_session)
+
+
+def style_memory_mb(checkpoint_dir):
+    """Approximate resident size of a restored style, its weights on disk"""
+    if has_fresh_frozen(checkpoint_dir):
+        checkpoint_dir = get_frozen_path(checkpoint_dir)
+    if os.path.isdir(checkpoint_dir):
+        size = sum(os.path.getsize(os.path.join(checkpoint_dir, filename))
+                   for filename in os.listdir(checkpoint_dir))
+    else:
+        size = os.path.getsize(checkpoint_dir)
+    return size / 2.0**20
+
+
+def within_budget(checkpoint_dirs, max_memory_mb):
+    """Longest prefix of checkpoint_dirs whose styles fit in max_memory_mb"""
+    selected, total = [], 0
+    for checkpoint_dir in checkpoint_dirs:
+        total += style_memory_mb(checkpoint_dir)
+        if total > max_memory_mb:
+            break
+        selected.append(checkpoint_dir)
+    return selected
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process-wide InferenceEngine"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = InferenceEngine()
+        return _engine
+
+
+def _engine_stats():
+    return _engine.stats() if _engine is not None else None
+
+
+register(Stats('deep_paint_engine', 'Inference engine', _engine_stats,
+               counters=('hits', 'misses', 'evictions')))
+
+
+def configure_engine(**kwargs):
+    """Replace the process-wide InferenceEngine, closing the old one"""
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.evict()
+        _engine = InferenceEngine(**kwargs)
+        return _engine
@@ -1,18 +1,53 @@
 from __future__ import print_function
-import transform
+import multiprocessing
 import numpy as np
 import os
-import tensorflow as tf
-from utils import save_img, get_img
-from collections import defaultdict
+import threading
+import tiling
+from engine import get_engine
+from metrics import resolution_bucket, stage_timer
+from pool import get_pool
+from scheduler import get_scheduler
+from utils import (decode_img, encode_img, get_img, get_img_shape, save_img,
+                   shrink_img)
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from Queue import Empty, Queue
 
 BATCH_SIZE = 4
 DEVICE = '/device:GPU:0'
 BASEDIR = os.getcwd()
+MAX_MEMORY_MB = tiling.MAX_MEMORY_MB
+DECODE_THREADS = 4
+ENCODE_THREADS = 2
+PIPELINE_DEPTH = 2
+# ffwd_different_dimensions pads images up to multiples of this many pixels
+SHAPE_BUCKET = int(os.environ.get('DEEP_PAINT_SHAPE_BUCKET', 128))
+
+
+def _load(src, checkpoint_dir, decode=get_img):
+    with stage_timer('decode', checkpoint_dir) as timer:
+        img = decode(src)
+        timer.labels['resolution'] = resolution_bucket(img.shape)
+    return img
+
+
+def _save(out_path, img, checkpoint_dir):
+    with stage_timer('encode', checkpoint_dir, img.shape):
+        save_img(out_path, img)
 
 
 def ffwd(data_in, paths_out, checkpoint_dir, device_t='/device:GPU:0',
-         batch_size=4, testing=False):
+         batch_size=4, testing=False, img_shape=None):
+    """Style a list of images in batches
+
+    Runs as a three stage pipeline: a thread pool decodes the next batches
+    while the current one is in sess.run, and another writes finished
+    images out in the background.
+
+    Image paths must all have the same shape unless img_shape is given, in
+    which case each image is padded up to it and its output cropped back.
+    """
 
     if testing:
         print('start ffwd')
@@ -24,64 +59,169 @@ def ffwd(data_in, paths_out, checkpoint_dir, device_t='/device:GPU:0',
 
     assert len(paths_out) > 0
     is_paths = type(data_in[0]) == str
+    is_padded = is_paths and img_shape is not None
     if is_paths:
         assert len(data_in) == len(paths_out)
-        img_shape = get_img(data_in[0]).shape
+        img_shape = img_shape or get_img_shape(data_in[0])
     else:
-        assert data_in.size[0] == len(paths_out)
-        # img_shape = X[0].shape  # X is not assigned prior to this call <-----
+        assert len(data_in) == len(paths_out)
+        img_shape = data_in[0].shape
 
-    g = tf.Graph()
     batch_size = min(len(paths_out), batch_size)
-    # curr_num = 0  # curr_num is never used <---------------------------------
-    soft_config = tf.ConfigProto(allow_soft_placement=True)
-    soft_config.gpu_options.allow_growth = True
-    with g.as_default(), g.device(device_t), \
-            tf.Session(config=soft_config) as sess:
-        batch_shape = (batch_size,) + img_shape
-        img_placeholder = tf.placeholder(tf.float32, shape=batch_shape,
-                                         name='img_placeholder')
-
-        preds = transform.net(img_placeholder)
-        saver = tf.train.Saver()
-        if os.path.isdir(checkpoint_dir):
-            ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
-            if ckpt and ckpt.model_checkpoint_path:
-                saver.restore(sess, ckpt.model_checkpoint_path)
-            else:
-                raise Exception("No checkpoint found...")
-        else:
-            saver.restore(sess, checkpoint_dir)
+    batch_shape = (batch_size,) + img_shape
+
+    # a trailing partial batch is zero-padded to batch_size and run in the
+    # same session; instance norm is per image, so the padding rows do not
+    # change the real outputs and are simply not written
+    num_iters = -(-len(paths_out) // batch_size)
+
+    def load_batch(pos, decoders):
+        X = np.zeros(batch_shape, dtype=np.float32)
+        curr_batch_in = data_in[pos:pos + batch_size]
+        if not is_paths:
+            X[:len(curr_batch_in)] = curr_batch_in
+            return X, [img_shape] * len(curr_batch_in)
+        shapes = []
+        for j, img in enumerate(decoders.map(
+                lambda src: _load(src, checkpoint_dir), curr_batch_in)):
+            shapes.append(img.shape)
+            if is_padded:
+                assert (img.shape[0] <= img_shape[0] and
+                        img.shape[1] <= img_shape[1]), \
+                    'Image is larger than its padded shape.'
+                img = tiling.pad(img, img_shape)
+            assert img.shape == img_shape, \
+                'Images have different dimensions. ' + \
+                'Resize images or use --allow-different-dimensions.'
+            X[j] = img
+        return X, shapes
+
+    # restored before any thread starts, so a bad checkpoint leaves
+    # nothing running
+    style_session = get_engine().get(checkpoint_dir, device_t)
+
+    # decode, sess.run and encode overlap: decoded batches and pending
+    # writes are bounded so memory stays flat on large jobs
+    decoded = Queue(PIPELINE_DEPTH)
+    decoders = ThreadPoolExecutor(DECODE_THREADS)
+    encoders = ThreadPoolExecutor(ENCODE_THREADS)
+
+    stop = threading.Event()
 
-        num_iters = int(len(paths_out) / batch_size)
+    def prefetch():
+        try:
+            for i in range(num_iters):
+                if stop.is_set():
+                    return
+                decoded.put(load_batch(i * batch_size, decoders))
+        except Exception as e:
+            decoded.put(e)
+
+    prefetcher = threading.Thread(target=prefetch, name='ffwd-prefetch')
+    prefetcher.daemon = True
+    prefetcher.start()
+
+    writes = deque()
+    try:
         for i in range(num_iters):
+            batch = decoded.get()
+            if isinstance(batch, Exception):
+                raise batch
+            X, shapes = batch
+
             pos = i * batch_size
             curr_batch_out = paths_out[pos:pos + batch_size]
-            if is_paths:
-                curr_batch_in = data_in[pos:pos + batch_size]
-                X = np.zeros(batch_shape, dtype=np.float32)
-                for j, path_in in enumerate(curr_batch_in):
-                    img = get_img(path_in)
-                    assert img.shape == img_shape, \
-                        'Images have different dimensions. ' + \
-                        'Resize images or use --allow-different-dimensions.'
-                    X[j] = img
-            else:
-                X = data_in[pos:pos + batch_size]
-
-            _preds = sess.run(preds, feed_dict={img_placeholder: X})
+            _preds = style_session.run(X)
             for j, path_out in enumerate(curr_batch_out):
-                save_img(path_out, _preds[j])
+                rows, cols = shapes[j][:2]
+                writes.append(encoders.submit(_save, path_out,
+                                              _preds[j, :rows, :cols],
+                                              checkpoint_dir))
+            while len(writes) > PIPELINE_DEPTH * batch_size:
+                writes.popleft().result()
+        for write in writes:
+            write.result()
+    finally:
+        style_session.release()
+        stop.set()
+        while prefetcher.is_alive():
+            try:
+                decoded.get(timeout=0.1)  # unblock a prefetcher put
+            except Empty:
+                pass
+        decoders.shutdown()
+        encoders.shutdown()
+
+
+def ffwd_tiled(img, checkpoint_dir, device_t=DEVICE,
+               max_memory_mb=MAX_MEMORY_MB, overlap=tiling.TILE_OVERLAP):
+    """Style an image in overlapping tiles so peak memory stays in budget
+
+    Tiles are sized and batched so each sess.run stays under max_memory_mb,
+    then blended back together across the overlap.
+    """
+    tile_size = tiling.tile_size_for_budget(max_memory_mb, overlap)
+    batch_size = tiling.tiles_per_batch(tile_size, max_memory_mb)
+    tiles, origins = tiling.split(img.astype(np.float32), tile_size, overlap)
 
-        remaining_in = data_in[num_iters * batch_size:]
-        remaining_out = paths_out[num_iters * batch_size:]
-    if len(remaining_in) > 0:
-        ffwd(remaining_in, remaining_out, checkpoint_dir,
-             device_t=device_t, batch_size=1)
+    with get_engine().get(checkpoint_dir, device_t) as style_session:
+        _preds = np.concatenate([
+            style_session.run(tiles[pos:pos + batch_size])
+            for pos in range(0, len(tiles), batch_size)])
+    return tiling.blend(_preds, origins, img.shape, overlap)
+
+
+def ffwd_array(img, checkpoint_dir, device='/device:CPU:0',
+               max_memory_mb=MAX_MEMORY_MB, max_edge=None):
+    """Style a decoded HxWx3 image array, return the styled array"""
+    if max_edge:
+        # compute grows with pixel count, so previews style a smaller copy
+        img = shrink_img(img, max_edge)
+    if not tiling.fits_budget(img.shape, max_memory_mb):
+        return ffwd_tiled(img, BASEDIR + checkpoint_dir, device,
+                          max_memory_mb)
+    scheduler = get_scheduler()
+    if max_memory_mb >= scheduler.max_memory_mb:
+        # concurrent calls for the same style are batched by the scheduler,
+        # as many at a time as its own budget allows
+        return scheduler.run(BASEDIR + checkpoint_dir, img, device)
+    return get_engine().run(BASEDIR + checkpoint_dir,
+                            img[np.newaxis].astype(np.float32), device)[0]
+
+
+def ffwd_bytes(data_in, checkpoint_dir, file_extension='jpg',
+               device='/device:CPU:0', max_memory_mb=MAX_MEMORY_MB,
+               max_edge=None, testing=False):
+    """Style an image held in memory, return the encoded output bytes
+
+    data_in is either encoded image bytes or an already decoded array, so
+    callers that have the pixels at hand skip the disk entirely.
+    """
+
+    if testing:
+        print('start ffwd_bytes')
+        print(' checkpoint_dir: ', checkpoint_dir)
+        print(' file_extension: ', file_extension)
+        print(' device: ', device)
+        print(' max_memory_mb: ', max_memory_mb)
+        print(' max_edge: ', max_edge)
+
+    inference_pool = get_pool()
+    if inference_pool is not None:
+        return inference_pool.ffwd_bytes(data_in, checkpoint_dir,
+                                         file_extension, device,
+                                         max_memory_mb, max_edge)
+
+    img = data_in
+    if not isinstance(data_in, np.ndarray):
+        img = _load(data_in, checkpoint_dir, decode_img)
+    _pred = ffwd_array(img, checkpoint_dir, device, max_memory_mb, max_edge)
+    with stage_timer('encode', checkpoint_dir, _pred.shape):
+        return encode_img(_pred, file_extension)
 
 
 def ffwd_to_img(in_path, out_path, checkpoint_dir, device='/device:CPU:0',
-                testing=False):
+                max_memory_mb=MAX_MEMORY_MB, max_edge=None, testing=False):
 
     if testing:
         print('start ffwd_to_img')
@@ -89,14 +229,86 @@ def ffwd_to_img(in_path, out_path, checkpoint_dir, device='/device:CPU:0',
         print(' out_path: ', out_path)
         print(' checkpoint_dir: ', checkpoint_dir)
         print(' device: ', device)
+        print(' max_memory_mb: ', max_memory_mb)
+        print(' max_edge: ', max_edge)
+
+    inference_pool = get_pool()
+    if inference_pool is not None:
+        return inference_pool.ffwd_to_img(in_path, out_path, checkpoint_dir,
+                                          device, max_memory_mb, max_edge)
+
+    img = _load(BASEDIR + in_path, checkpoint_dir)
+    _save(BASEDIR + out_path, ffwd_array(img, checkpoint_dir, device,
+                                         max_memory_mb, max_edge),
+          checkpoint_dir)
+
+
+def ffwd_many(data_in, out_paths, checkpoint_dirs, device='/device:CPU:0',
+              max_memory_mb=MAX_MEMORY_MB, testing=False):
+    """Style one image with several checkpoints
+
+    data_in is an image path or an already decoded array. The source is
+    decoded at most once and each style's resident session runs over the
+    shared array, in parallel where cores allow.
+    """
+
+    if testing:
+        print('start ffwd_many')
+        print(' data_in: ', data_in)
+        print(' out_paths: ', out_paths)
+        print(' checkpoint_dirs: ', checkpoint_dirs)
+        print(' device: ', device)
+
+    assert len(out_paths) == len(checkpoint_dirs)
+    inference_pool = get_pool()
+    if inference_pool is not None:
+        return inference_pool.ffwd_many(data_in, out_paths, checkpoint_dirs,
+                                        device, max_memory_mb)
+
+    img = data_in
+    if not isinstance(data_in, np.ndarray):
+        img = _load(BASEDIR + data_in, None)
+    X = img[np.newaxis].astype(np.float32)
+    engine = get_engine()
+
+    # every style in flight holds its own activations, so only as many run
+    # at once as fit in the budget. An image is tiled only when it does not
+    # fit alone, so it renders the same as when styled by itself and the
+    # output cache can share the result.
+    workers = max(1, min(len(out_paths), multiprocessing.cpu_count(),
+                         tiling.images_per_batch(img.shape, max_memory_mb)))
+    is_tiled = not tiling.fits_budget(img.shape, max_memory_mb)
+
+    def style_one(out_path, checkpoint_dir):
+        if is_tiled:
+            _pred = ffwd_tiled(img, BASEDIR + checkpoint_dir, device,
+                               max_memory_mb)
+        else:
+            _pred = engine.run(BASEDIR + checkpoint_dir, X, device)[0]
+        _save(BASEDIR + out_path, _pred, checkpoint_dir)
+
+    executor = ThreadPoolExecutor(workers)
+    try:
+        list(executor.map(style_one, out_paths, checkpoint_dirs))
+    finally:
+        executor.shutdown()
+
 
-    paths_in, paths_out = [BASEDIR + in_path], [BASEDIR + out_path]
-    ffwd(paths_in, paths_out, BASEDIR + checkpoint_dir, batch_size=1,
-         device_t=device)
+def bucket_shape(shape, bucket=SHAPE_BUCKET):
+    """Round an image shape's rows and cols up to a multiple of bucket"""
+    rows, cols = [-(-edge // bucket) * bucket for edge in shape[:2]]
+    return (rows, cols) + tuple(shape[2:])
 
 
 def ffwd_different_dimensions(in_path, out_path, checkpoint_dir,
                               device_t=DEVICE, batch_size=4, testing=False):
+    """Style images of mixed sizes, batched by padded size bucket
+
+    Shapes are read from the image headers only, and each image is padded
+    up to the nearest bucket so a handful of buckets cover every upload.
+    Returns the number of images and buckets, the graphs built and the
+    fraction of extra pixels the padding cost.
+    """
 
     if testing:
         print('start ffwd_different_dimensions')
@@ -108,13 +320,28 @@ def ffwd_different_dimensions(in_path, out_path, checkpoint_dir,
 
     in_path_of_shape = defaultdict(list)
     out_path_of_shape = defaultdict(list)
-    for i in range(len(in_path)):
-        in_image = in_path[i]
-        out_image = out_path[i]
-        shape = "%dx%dx%d" % get_img(in_image).shape
-        in_path_of_shape[shape].append(in_image)
-        out_path_of_shape[shape].append(out_image)
-    for shape in in_path_of_shape:
-        print('Processing images of shape %s' % shape)
-        ffwd(in_path_of_shape[shape], out_path_of_shape[shape],
-             checkpoint_dir, device_t, batch_size)
+    pixels = padded_pixels = 0
+    for in_image, out_image in zip(in_path, out_path):
+        shape = get_img_shape(in_image)
+        bucket = bucket_shape(shape)
+        pixels += shape[0] * shape[1]
+        padded_pixels += bucket[0] * bucket[1]
+        in_path_of_shape[bucket].append(in_image)
+        out_path_of_shape[bucket].append(out_image)
+
+    engine = get_engine()
+    misses = engine.stats()['misses']
+    for bucket in in_path_of_shape:
+        print('Processing images in bucket %dx%dx%d' % bucket)
+        ffwd(in_path_of_shape[bucket], out_path_of_shape[bucket],
+             checkpoint_dir, device_t, batch_size, img_shape=bucket)
+
+    report = {
+        'images': len(in_path),
+        'buckets': len(in_path_of_shape),
+        'graphsBuilt': engine.stats()['misses'] - misses,
+        'paddingOverhead': float(padded_pixels) / pixels - 1 if pixels else 0,
+    }
+    print('{images} images in {buckets} buckets, {graphsBuilt} graphs built, '
+          '{paddingOverhead:.1%} padding overhead'.format(**report))
+    return report
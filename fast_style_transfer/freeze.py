@@ -0,0 +1,114 @@
+"""Frozen, inference-only graphs for style checkpoints
+
+A training checkpoint has to be restored into a freshly built transform.net,
+variables, initializers and all. Freezing bakes the restored weights into
+constants, strips everything the forward pass does not need and folds what
+constant arithmetic it can. Instance norm is left as it is: its multiplier,
+scale * rsqrt(sigma_sq + epsilon), depends on each image's own variance,
+so there is no constant to fold into the preceding convolution. The result
+is cached next to the checkpoint and preferred by the inference engine
+whenever it is at least as new.
+
+    $ python fast_style_transfer/freeze.py static/style/*.ckpt
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import tensorflow as tf
+import transform
+from tensorflow.tools.graph_transforms import TransformGraph
+
+BATCH_SHAPE = (None, None, None, 3)
+INPUT_NAME = 'img_placeholder'
+OUTPUT_NAME = 'preds'
+FROZEN_SUFFIX = '.frozen.pb'
+TRANSFORMS = [
+    'strip_unused_nodes',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'merge_duplicate_nodes',
+    'sort_by_execution_order',
+]
+
+
+def restore(saver, sess, checkpoint_dir):
+    """Restore a checkpoint file, or the latest checkpoint in a directory"""
+    if os.path.isdir(checkpoint_dir):
+        ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+        if ckpt and ckpt.model_checkpoint_path:
+            saver.restore(sess, ckpt.model_checkpoint_path)
+        else:
+            raise Exception("No checkpoint found...")
+    else:
+        saver.restore(sess, checkpoint_dir)
+
+
+def get_frozen_path(checkpoint_dir):
+    """Where the frozen graph for a checkpoint file or directory lives"""
+    if os.path.isdir(checkpoint_dir):
+        return os.path.join(checkpoint_dir, 'frozen.pb')
+    return checkpoint_dir + FROZEN_SUFFIX
+
+
+def has_fresh_frozen(checkpoint_dir):
+    """Whether a frozen graph exists and is not older than its checkpoint"""
+    frozen_path = get_frozen_path(checkpoint_dir)
+    if not os.path.isfile(frozen_path):
+        return False
+    if not os.path.exists(checkpoint_dir):
+        return True
+    return os.path.getmtime(frozen_path) >= os.path.getmtime(checkpoint_dir)
+
+
+def freeze(checkpoint_dir, frozen_path=None):
+    """Convert a checkpoint into a frozen, constant-folded GraphDef file"""
+    frozen_path = frozen_path or get_frozen_path(checkpoint_dir)
+    with tf.Graph().as_default() as g, tf.Session() as sess:
+        img_placeholder = tf.placeholder(tf.float32, shape=BATCH_SHAPE,
+                                         name=INPUT_NAME)
+        tf.identity(transform.net(img_placeholder,
+                                  **transform.read_config(checkpoint_dir)),
+                    name=OUTPUT_NAME)
+        restore(tf.train.Saver(), sess, checkpoint_dir)
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            sess, g.as_graph_def(), [OUTPUT_NAME])
+
+    graph_def = TransformGraph(graph_def, [INPUT_NAME], [OUTPUT_NAME],
+                               TRANSFORMS)
+    # write then rename so a running engine never loads a partial file
+    tmp_path = frozen_path + '.tmp'
+    with tf.gfile.GFile(tmp_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    os.rename(tmp_path, frozen_path)
+    return frozen_path
+
+
+def load_frozen(frozen_path):
+    """Import a frozen graph into the default graph
+
+    Returns the input placeholder and output tensors.
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(frozen_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    img_placeholder, preds = tf.import_graph_def(
+        graph_def, return_elements=[INPUT_NAME + ':0', OUTPUT_NAME + ':0'],
+        name='')
+    return img_placeholder, preds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('checkpoint_dirs', nargs='+')
+    parser.add_argument('--force', action='store_true',
+                        help='refreeze even if the frozen graph is current')
+    args = parser.parse_args()
+
+    for checkpoint_dir in args.checkpoint_dirs:
+        if checkpoint_dir.endswith(FROZEN_SUFFIX):
+            continue
+        if not args.force and has_fresh_frozen(checkpoint_dir):
+            print('%s is up to date' % get_frozen_path(checkpoint_dir))
+            continue
+        print('%s -> %s' % (checkpoint_dir, freeze(checkpoint_dir)))
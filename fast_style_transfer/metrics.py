@@ -0,0 +1,231 @@
+"""Latency histograms in the Prometheus text exposition format
+
+Each styling stage (decode, graph build, checkpoint restore, sess.run,
+encode and the database commit) is timed into one histogram labelled by
+stage, style and resolution bucket, so a slow render can be traced to the
+stage responsible. The inference engine and the output cache export their
+counters alongside, through Stats. server.py exposes the registry on
+/metrics; a worker can serve its own, along with a /ready health check,
+with serve().
+"""
+
+import os
+import re
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+# longest image edge upper bounds used as the resolution label
+RESOLUTION_BUCKETS = (256, 512, 1024, 2048)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{name}="{value}"'.format(
+        name=name, value=str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)) + '}'
+
+
+class Histogram(object):
+    """Cumulative histogram of observations, one series per label set"""
+
+    def __init__(self, name, documentation, label_names=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Histogram name="{name}">'.format(name=self.name)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self._lock:
+            counts, total = self._series.get(key, ([0] * len(self.buckets),
+                                                   0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._series[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Context manager timing its body into this histogram
+
+        Labels can still be filled in through the returned timer's labels
+        dict, e.g. once an image is decoded and its size is known.
+        """
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP {name} {doc}'.format(
+                     name=self.name, doc=self.documentation),
+                 '# TYPE {name} histogram'.format(name=self.name)]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, (counts, total) in series:
+            for bound, count in zip(self.buckets, counts):
+                lines.append('{name}_bucket{labels} {count}'.format(
+                    name=self.name, count=count, labels=_format_labels(
+                        self.label_names + ('le',),
+                        key + (_format_value(bound),))))
+            labels = _format_labels(self.label_names, key)
+            lines.append('{name}_sum{labels} {total}'.format(
+                name=self.name, labels=labels, total=_format_value(total)))
+            lines.append('{name}_count{labels} {count}'.format(
+                name=self.name, labels=labels, count=counts[-1]))
+        return lines
+
+
+class Stats(object):
+    """Counters and gauges read from a component's stats() dict on render
+
+    get_stats returns the dict, or None while the component does not exist
+    in this process. Keys in counters are exported as counters, the rest
+    as gauges, e.g. {'hits': 3, 'hitRate': .5} under deep_paint_engine
+    becomes deep_paint_engine_hits_total and deep_paint_engine_hit_rate.
+    """
+
+    def __init__(self, name, documentation, get_stats, counters=()):
+        self.name = name
+        self.documentation = documentation
+        self.get_stats = get_stats
+        self.counters = set(counters)
+
+    def __repr__(self):
+        return '<Stats name="{name}">'.format(name=self.name)
+
+    def render(self):
+        stats = self.get_stats()
+        if stats is None:
+            return []
+        lines = []
+        for key, value in sorted(stats.items()):
+            if isinstance(value, bool) or not isinstance(value,
+                                                         (int, float)):
+                continue
+            name = '{prefix}_{key}'.format(
+                prefix=self.name,
+                key=re.sub('([a-z0-9])([A-Z])', r'\1_\2', key).lower())
+            kind = 'gauge'
+            if key in self.counters:
+                name += '_total'
+                kind = 'counter'
+            lines.extend([
+                '# HELP {name} {doc} {key}.'.format(
+                    name=name, doc=self.documentation.rstrip('.'), key=key),
+                '# TYPE {name} {kind}'.format(name=name, kind=kind),
+                '{name} {value}'.format(name=name,
+                                        value=_format_value(value))])
+        return lines
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start_time, **self.labels)
+
+
+STAGE_SECONDS = Histogram(
+    'deep_paint_stage_seconds', 'Time spent in each styling stage.',
+    ('stage', 'style_id', 'resolution'))
+REQUEST_SECONDS = Histogram(
+    'deep_paint_request_seconds', 'Flask request latency by endpoint.',
+    ('endpoint', 'method', 'status'))
+REGISTRY = [STAGE_SECONDS, REQUEST_SECONDS]
+
+
+def register(metric):
+    """Add a Histogram or Stats to what render() exports"""
+    REGISTRY.append(metric)
+    return metric
+
+
+def style_label(checkpoint_dir):
+    """Style id label for a checkpoint, e.g. '3' for static/style/3.ckpt"""
+    return os.path.basename(checkpoint_dir.rstrip('/')).split('.')[0]
+
+
+def resolution_bucket(shape):
+    """Resolution label for an HxW[xC] or NxHxWxC shape"""
+    if len(shape) == 4:
+        shape = shape[1:]
+    edge = max(shape[0], shape[1])
+    for bound in RESOLUTION_BUCKETS:
+        if edge <= bound:
+            return str(bound)
+    return '+Inf'
+
+
+def stage_timer(stage, checkpoint_dir=None, shape=None):
+    """Time a styling stage for the given checkpoint and image shape"""
+    labels = {'stage': stage}
+    if checkpoint_dir:
+        labels['style_id'] = style_label(checkpoint_dir)
+    if shape is not None:
+        labels['resolution'] = resolution_bucket(shape)
+    return STAGE_SECONDS.time(**labels)
+
+
+def render():
+    """The whole registry in Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/ready':
+            ready = self.server.ready
+            if ready is not None and not ready.is_set():
+                self.send_error(503, 'warming up')
+                return
+            body = 'ready\n'
+        elif self.path == '/metrics':
+            body = render()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host='', ready=None):
+    """Serve /metrics from a background thread, return the server
+
+    /ready answers 503 until the optional ready Event is set.
+    """
+    server = HTTPServer((host, port), _MetricsHandler)
+    server.ready = ready
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
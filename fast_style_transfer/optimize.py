@@ -1,32 +1,76 @@
 from __future__ import print_function
 import functools
+import multiprocessing
 import vgg
 import time
 import tensorflow as tf
 import numpy as np
 import transform
+from collections import deque
+from shards import CONTENT_SHAPE, ContentShards
 from utils import get_img
 
 STYLE_LAYERS = ('relu1_1', 'relu2_1', 'relu3_1', 'relu4_1', 'relu5_1')
 CONTENT_LAYER = 'relu4_2'
 DEVICES = 'CUDA_VISIBLE_DEVICES'
+# processes decoding and resizing content images; 0 decodes inline
+DECODE_PROCESSES = multiprocessing.cpu_count()
+# batches decoded ahead of the training step
+PREFETCH_BATCHES = 4
 
 
 # np arr, np arr
 def optimize(content_targets, style_target, content_weight, style_weight,
              tv_weight, vgg_path, epochs=2, print_iterations=1000,
              batch_size=4, save_path='saver/fns.ckpt', slow=False,
-             learning_rate=1e-3, debug=False):
+             learning_rate=1e-3, debug=False, width=transform.WIDTH,
+             residual_blocks=transform.RESIDUAL_BLOCKS,
+             decode_processes=DECODE_PROCESSES,
+             prefetch_batches=PREFETCH_BATCHES, shared_vgg=True,
+             cache_content_features=False):
+    """Train transform.net, yielding progress every print_iterations
+
+    width and residual_blocks size the network, see transform.VARIANTS.
+    content_targets is a list of image paths or a ContentShards of
+    preprocessed images, which are read in a fresh shuffle every epoch.
+    Image paths are decoded by decode_processes worker processes up to
+    prefetch_batches batches ahead of the training step; with debug on,
+    each step prints how long it waited on them next to its batch time.
+    shared_vgg runs content images and predictions through VGG together
+    as one batch instead of building a tower for each.
+    cache_content_features, for ContentShards only, computes the
+    CONTENT_LAYER features of the whole set once and stores them next to
+    the shards; every training run on the same VGG weights then feeds them
+    in place of the content tower.
+    """
     if slow:
         batch_size = 1
-    mod = len(content_targets) % batch_size
-    if mod > 0:
+    num_examples = len(content_targets) - len(content_targets) % batch_size
+    if num_examples < len(content_targets):
         print("Train set has been trimmed slightly..")
-        content_targets = content_targets[:-mod]
+
+    if cache_content_features:
+        if not isinstance(content_targets, ContentShards):
+            raise ValueError('cache_content_features needs ContentShards '
+                             'content_targets')
+        features_shape = content_targets.load_features(
+            precompute_content_features(content_targets, vgg_path))
+        batches = content_targets.batches(batch_size, epochs,
+                                          with_features=True)
+    elif isinstance(content_targets, ContentShards):
+        batches = content_targets.batches(batch_size, epochs)
+    else:
+        content_targets = content_targets[:num_examples]
+        # fork the decoders before any session starts tensorflow's threads
+        decoders = None
+        if decode_processes > 0:
+            decoders = multiprocessing.Pool(decode_processes)
+        batches = _batches(content_targets * epochs, batch_size, decoders,
+                           prefetch_batches)
 
     style_features = {}
 
-    batch_shape = (batch_size, 256, 256, 3)
+    batch_shape = (batch_size,) + CONTENT_SHAPE
     style_shape = (1,) + style_target.shape
     print(style_shape)
 
@@ -35,7 +79,8 @@ def optimize(content_targets, style_target, content_weight, style_weight,
         style_image = tf.placeholder(tf.float32, shape=style_shape,
                                      name='style_image')
         style_image_pre = vgg.preprocess(style_image)
-        net = vgg.net(vgg_path, style_image_pre)
+        net = vgg.net(vgg_path, style_image_pre,
+                      last_layer=vgg.deepest(STYLE_LAYERS))
         style_pre = np.array([style_target])
         for layer in STYLE_LAYERS:
             features = net[layer].eval(feed_dict={style_image: style_pre})
@@ -48,21 +93,40 @@ def optimize(content_targets, style_target, content_weight, style_weight,
                                    name="X_content")
         X_pre = vgg.preprocess(X_content)
 
-        # precompute content features
-        content_features = {}
-        content_net = vgg.net(vgg_path, X_pre)
-        content_features[CONTENT_LAYER] = content_net[CONTENT_LAYER]
-
         if slow:
             preds = tf.Variable(
                 tf.random_normal(X_content.get_shape()) * 0.256
             )
             preds_pre = preds
         else:
-            preds = transform.net(X_content / 255.0)
+            preds = transform.net(X_content / 255.0, width=width,
+                                  residual_blocks=residual_blocks)
             preds_pre = vgg.preprocess(preds)
 
-        net = vgg.net(vgg_path, preds_pre)
+        # content features only go as deep as the content layer
+        content_features = {}
+        last_layer = vgg.deepest(STYLE_LAYERS + (CONTENT_LAYER,))
+        if cache_content_features:
+            content_features[CONTENT_LAYER] = tf.placeholder(
+                tf.float32, shape=(batch_size,) + features_shape,
+                name='content_features')
+            net = vgg.net(vgg_path, preds_pre, last_layer=last_layer)
+        elif shared_vgg:
+            # one pass over content and predictions up to the content
+            # layer, then the predictions carry on alone
+            shared_net = vgg.net(vgg_path, tf.concat([X_pre, preds_pre], 0),
+                                 last_layer=CONTENT_LAYER)
+            content_features[CONTENT_LAYER] = \
+                shared_net[CONTENT_LAYER][:batch_size]
+            net = dict((name, layer[batch_size:])
+                       for name, layer in shared_net.items())
+            net.update(vgg.net(vgg_path, net[CONTENT_LAYER],
+                               last_layer=last_layer,
+                               after_layer=CONTENT_LAYER))
+        else:
+            content_net = vgg.net(vgg_path, X_pre, last_layer=CONTENT_LAYER)
+            content_features[CONTENT_LAYER] = content_net[CONTENT_LAYER]
+            net = vgg.net(vgg_path, preds_pre, last_layer=last_layer)
 
         content_size = (_tensor_size(content_features[CONTENT_LAYER]) *
                         batch_size)
@@ -75,10 +139,10 @@ def optimize(content_targets, style_target, content_weight, style_weight,
         style_losses = []
         for style_layer in STYLE_LAYERS:
             layer = net[style_layer]
-            bs, height, width, filters = map(lambda i: i.value,
-                                             layer.get_shape())
-            size = height * width * filters
-            feats = tf.reshape(layer, (bs, height * width, filters))
+            bs, height, layer_width, filters = map(lambda i: i.value,
+                                                   layer.get_shape())
+            size = height * layer_width * filters
+            feats = tf.reshape(layer, (bs, height * layer_width, filters))
             feats_T = tf.transpose(feats, perm=[0, 2, 1])
             grams = tf.matmul(feats_T, feats) / size
             style_gram = style_features[style_layer]
@@ -107,27 +171,29 @@ def optimize(content_targets, style_target, content_weight, style_weight,
         uid = random.randint(1, 100)
         print("UID: %s" % uid)
         for epoch in range(epochs):
-            num_examples = len(content_targets)
             iterations = 0
             while iterations * batch_size < num_examples:
                 start_time = time.time()
-                curr = iterations * batch_size
-                step = curr + batch_size
-                X_batch = np.zeros(batch_shape, dtype=np.float32)
-                for j, img_p in enumerate(content_targets[curr:step]):
-                    X_batch[j] = get_img(img_p, (256, 256, 3)).astype(
-                        np.float32)
+                batch = next(batches)
+                wait_time = time.time() - start_time
 
                 iterations += 1
-                assert X_batch.shape[0] == batch_size
+                if cache_content_features:
+                    X_batch, features_batch = batch
+                    feed_dict = {content_features[CONTENT_LAYER]:
+                                 features_batch}
+                else:
+                    X_batch, feed_dict = batch, {}
+                assert X_batch.shape == batch_shape
 
-                feed_dict = {X_content: X_batch}
+                feed_dict[X_content] = X_batch
 
                 train_step.run(feed_dict=feed_dict)
                 end_time = time.time()
                 delta_time = end_time - start_time
                 if debug:
-                    print("UID: %s, batch time: %s" % (uid, delta_time))
+                    print("UID: %s, batch time: %s, data wait: %s" %
+                          (uid, delta_time, wait_time))
                 is_print_iter = int(iterations) % print_iterations == 0
                 if slow:
                     is_print_iter = epoch % print_iterations == 0
@@ -136,9 +202,7 @@ def optimize(content_targets, style_target, content_weight, style_weight,
                 should_print = is_print_iter or is_last
                 if should_print:
                     to_get = [style_loss, content_loss, tv_loss, loss, preds]
-                    test_feed_dict = {X_content: X_batch}
-
-                    tup = sess.run(to_get, feed_dict=test_feed_dict)
+                    tup = sess.run(to_get, feed_dict=feed_dict)
                     _style_loss, _content_loss, _tv_loss, _loss, _preds = tup
                     losses = (_style_loss, _content_loss, _tv_loss, _loss)
                     if slow:
@@ -149,6 +213,66 @@ def optimize(content_targets, style_target, content_weight, style_weight,
                     yield(_preds, losses, iterations, epoch)
 
 
+def content_features_key(vgg_path, shape=CONTENT_SHAPE):
+    """Cache key for CONTENT_LAYER features: VGG weights, layer and size"""
+    return '{weights}-{layer}-{rows}x{cols}'.format(
+        weights=vgg.weights_hash(vgg_path)[:16], layer=CONTENT_LAYER,
+        rows=shape[0], cols=shape[1])
+
+
+def precompute_content_features(content, vgg_path, batch_size=16):
+    """Store CONTENT_LAYER features of a ContentShards, return their key
+
+    Nothing is computed if features for these weights and this image size
+    are already stored.
+    """
+    key = content_features_key(vgg_path, content.shape)
+    if content.has_features(key):
+        return key
+    with tf.Graph().as_default(), tf.Session() as sess:
+        X_content = tf.placeholder(tf.float32, shape=(None,) + content.shape,
+                                   name='X_content')
+        features = vgg.net(vgg_path, vgg.preprocess(X_content),
+                           last_layer=CONTENT_LAYER)[CONTENT_LAYER]
+        content.write_features(
+            key, lambda X: sess.run(features, feed_dict={X_content: X}),
+            batch_size)
+    return key
+
+
+def _load_content(img_p):
+    return get_img(img_p, CONTENT_SHAPE).astype(np.float32)
+
+
+def _batches(paths, batch_size, decoders=None, depth=PREFETCH_BATCHES):
+    """Yield float32 batches of the content images at paths, in order
+
+    With a decoders pool the next depth batches are decoded in the
+    background while the current one trains; only those are held in
+    memory however long the list of paths is. The pool is terminated once
+    the batches run out or the generator is closed.
+    """
+    starts = range(0, len(paths), batch_size)
+    if decoders is None:
+        for pos in starts:
+            yield np.array([_load_content(img_p)
+                            for img_p in paths[pos:pos + batch_size]])
+        return
+
+    pending = deque()
+    try:
+        for pos in starts:
+            pending.append(decoders.map_async(
+                _load_content, paths[pos:pos + batch_size]))
+            if len(pending) > depth:
+                yield np.array(pending.popleft().get())
+        while pending:
+            yield np.array(pending.popleft().get())
+    finally:
+        decoders.terminate()
+        decoders.join()
+
+
 def _tensor_size(tensor):
     from operator import mul
     return functools.reduce(mul, (d.value for d in tensor.get_shape()[1:]), 1)
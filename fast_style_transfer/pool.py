@@ -0,0 +1,247 @@
+"""Process-pool inference backend with explicit CPU thread budgets
+
+Left alone, every tensorflow session sizes its thread pools to all cores, so
+concurrent jobs on a many-core box oversubscribe the CPU and slow each other
+down. The pool runs inference in a fixed number of worker processes, each
+with its own intra_op/inter_op thread budget and, optionally, pinned to a
+disjoint set of cores.
+
+Enable it for ffwd_to_img, ffwd_bytes and ffwd_many by setting
+DEEP_PAINT_INFERENCE_PROCESSES. Compare worker x thread splits with:
+
+    $ python fast_style_transfer/pool.py path/to/style.ckpt --splits 1x8 2x4
+"""
+
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+from engine import configure_engine, get_engine
+
+INFERENCE_PROCESSES = int(os.environ.get('DEEP_PAINT_INFERENCE_PROCESSES', 0))
+PIN_CORES = os.environ.get('DEEP_PAINT_PIN_CORES', '') == '1'
+
+# set inside pool processes so work they are handed is never re-dispatched
+_in_worker = False
+
+
+def _available_cores():
+    """Core IDs this process may run on, not just range(cpu_count())"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        import psutil
+        return sorted(psutil.Process().cpu_affinity())
+    except (ImportError, AttributeError):
+        return list(range(multiprocessing.cpu_count()))
+
+
+def _worker_index():
+    """0-based index of this pool process
+
+    Replacement processes, e.g. for one that was OOM killed, get fresh
+    indexes, so callers wrap it around the number of processes.
+    """
+    identity = multiprocessing.current_process()._identity
+    return identity[-1] - 1 if identity else 0
+
+
+def split_cores(cores, processes):
+    """Split core IDs into one set per process, as evenly as they go
+
+    Any remainder goes one core each to the later sets; with more
+    processes than cores, processes share cores round robin.
+    """
+    cores = sorted(cores)
+    if processes >= len(cores):
+        return [set([cores[i % len(cores)]]) for i in range(processes)]
+    return [set(cores[i * len(cores) // processes:
+                      (i + 1) * len(cores) // processes])
+            for i in range(processes)]
+
+
+def pick_core_set(core_sets, worker_index):
+    """The core set of the pool process with this index
+
+    Processes started to replace dead ones get indexes past the end, so
+    they wrap around to the start.
+    """
+    return core_sets[worker_index % len(core_sets)]
+
+
+def _pin(cores):
+    """Restrict the current process to the given cores where supported"""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+        return True
+    try:
+        import psutil
+    except ImportError:
+        print('CPU affinity unsupported here, worker %d not pinned' %
+              os.getpid())
+        return False
+    psutil.Process().cpu_affinity(list(cores))
+    return True
+
+
+def _init_worker(intra_op_threads, inter_op_threads, core_sets, warm_up,
+                 ready):
+    global _in_worker
+    _in_worker = True
+    if core_sets is not None:
+        _pin(pick_core_set(core_sets, _worker_index()))
+    engine = configure_engine(intra_op_threads=intra_op_threads,
+                              inter_op_threads=inter_op_threads)
+    if warm_up is not None:
+        engine.warm_up(*warm_up)
+    ready.put(os.getpid())
+
+
+def _ffwd_to_img(*args):
+    from evaluate import ffwd_to_img
+    return ffwd_to_img(*args)
+
+
+def _ffwd_bytes(*args):
+    from evaluate import ffwd_bytes
+    return ffwd_bytes(*args)
+
+
+def _ffwd_many(*args):
+    from evaluate import ffwd_many
+    return ffwd_many(*args)
+
+
+def _style_array(checkpoint_dir, X, device_t):
+    return get_engine().run(checkpoint_dir, X, device_t)
+
+
+class InferencePool(object):
+    """A fixed set of inference processes sharing the machine's cores
+
+    Each process gets intra_op_threads/inter_op_threads tensorflow threads;
+    by default the cores are split evenly between the processes. With
+    pin_cores each process is also bound to its own slice of cores.
+
+    warm_up is an optional (checkpoint_dirs, sizes, device_t) tuple every
+    process runs through InferenceEngine.warm_up as it starts; wait_ready
+    blocks until all of them have finished.
+    """
+
+    def __init__(self, processes=None, intra_op_threads=None,
+                 inter_op_threads=1, pin_cores=PIN_CORES, warm_up=None):
+        available = _available_cores()
+        cores = len(available)
+        self.processes = processes or INFERENCE_PROCESSES or 1
+        self.intra_op_threads = (intra_op_threads or
+                                 max(cores // self.processes, 1))
+        self.inter_op_threads = inter_op_threads
+        self.pin_cores = pin_cores
+
+        core_sets = None
+        if pin_cores:
+            core_sets = split_cores(available, self.processes)
+        self._ready = multiprocessing.Queue()
+        self._pool = multiprocessing.Pool(
+            self.processes, _init_worker,
+            (self.intra_op_threads, self.inter_op_threads, core_sets,
+             warm_up, self._ready))
+
+    def __repr__(self):
+        return ('<InferencePool processes={p} intra_op_threads={intra} '
+                'inter_op_threads={inter}>').format(
+            p=self.processes, intra=self.intra_op_threads,
+            inter=self.inter_op_threads)
+
+    def wait_ready(self):
+        """Block until every process has started and warmed up"""
+        for _ in range(self.processes):
+            self._ready.get()
+
+    def ffwd_to_img(self, *args):
+        return self._pool.apply(_ffwd_to_img, args)
+
+    def ffwd_bytes(self, *args):
+        return self._pool.apply(_ffwd_bytes, args)
+
+    def ffwd_many(self, *args):
+        return self._pool.apply(_ffwd_many, args)
+
+    def run_async(self, checkpoint_dir, X, device_t='/device:CPU:0'):
+        """Style a batch array in a pool process, return an AsyncResult"""
+        return self._pool.apply_async(_style_array,
+                                      (checkpoint_dir, X, device_t))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(warm_up=None):
+    """Return the process-wide InferencePool, or None when it is disabled
+
+    warm_up is passed on to InferencePool when the pool is first created.
+    """
+    global _pool
+    if _in_worker or INFERENCE_PROCESSES < 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = InferencePool(warm_up=warm_up)
+        return _pool
+
+
+def benchmark(checkpoint_dir, splits, images=32, size=512,
+              device_t='/device:CPU:0', pin_cores=False):
+    """Measure images/sec for each (processes, intra_op_threads) split"""
+    X = np.random.uniform(0, 255, (1, size, size, 3)).astype(np.float32)
+    results = []
+    for processes, threads in splits:
+        inference_pool = InferencePool(processes, threads, 1, pin_cores)
+        # warm up the processes so restores are not part of the timing
+        warm = [inference_pool.run_async(checkpoint_dir, X, device_t)
+                for _ in range(processes * 2)]
+        [result.get() for result in warm]
+
+        start_time = time.time()
+        pending = [inference_pool.run_async(checkpoint_dir, X, device_t)
+                   for _ in range(images)]
+        [result.get() for result in pending]
+        elapsed = time.time() - start_time
+        inference_pool.close()
+
+        results.append({
+            'processes': processes,
+            'intraOpThreads': threads,
+            'pinCores': pin_cores,
+            'images': images,
+            'size': size,
+            'imagesPerSec': images / elapsed,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('checkpoint_dir')
+    parser.add_argument('--splits', nargs='+', default=['1x%d' % (
+        multiprocessing.cpu_count())],
+        help='processes x intra-op threads, e.g. 2x4')
+    parser.add_argument('--images', type=int, default=32)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--device', default='/device:CPU:0')
+    parser.add_argument('--pin-cores', action='store_true')
+    args = parser.parse_args()
+
+    splits = [tuple(int(n) for n in split.split('x')) for split in args.splits]
+    for result in benchmark(args.checkpoint_dir, splits, args.images,
+                            args.size, args.device, args.pin_cores):
+        print('{processes}x{intraOpThreads}: {imagesPerSec:.2f} images/sec'
+              .format(**result))
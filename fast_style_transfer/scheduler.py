@@ -0,0 +1,246 @@
+"""Cross-request micro-batching for style inference
+
+Concurrent callers styling images with the same checkpoint each used to pay
+for their own sess.run. The scheduler holds incoming images for up to
+max_wait_ms, groups the ones that share a checkpoint, device and image shape
+and runs each group as one batch through the inference engine, then hands
+every caller its own result. A batch never holds more images than fit in
+max_memory_mb together (see tiling.BYTES_PER_PIXEL): at the default budget
+of 1024MB, images up to about 724x724 pair up but a 1024x1024 render fills
+the budget alone and runs unbatched. Raise DEEP_PAINT_INFERENCE_MEMORY_MB
+to batch larger renders.
+
+Batches run on a small thread pool, at most one at a time per group, so a
+slow batch or a cold style's checkpoint restore only holds up requests for
+the same style and shape, and previews never queue behind full renders.
+
+Benchmark against unbatched runs with:
+
+    $ python fast_style_transfer/scheduler.py path/to/style.ckpt
+"""
+
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+import tiling
+from concurrent.futures import Future, ThreadPoolExecutor
+from engine import get_engine
+
+MAX_WAIT_MS = float(os.environ.get('DEEP_PAINT_BATCH_WAIT_MS', 10))
+MAX_BATCH = int(os.environ.get('DEEP_PAINT_MAX_BATCH', 4))
+# batches of different groups that may run at once
+BATCH_THREADS = int(os.environ.get('DEEP_PAINT_BATCH_THREADS', 4))
+
+
+class BatchScheduler(object):
+    """Groups single-image requests into batched engine runs
+
+    Counters:
+        requests  images submitted
+        batches   sess.run calls made on their behalf
+    """
+
+    def __init__(self, engine=None, max_wait_ms=MAX_WAIT_MS,
+                 max_batch=MAX_BATCH, max_memory_mb=tiling.MAX_MEMORY_MB,
+                 threads=BATCH_THREADS):
+        assert max_batch > 0
+        self._engine = engine
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_memory_mb = max_memory_mb
+        self.requests = 0
+        self.batches = 0
+        self._pending = {}
+        self._deadlines = {}
+        # keys with a batch in flight
+        self._running = set()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(threads)
+        self._thread = threading.Thread(target=self._dispatch,
+                                        name='batch-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return '<BatchScheduler max_batch={batch} max_wait_ms={wait}>'.format(
+            batch=self.max_batch, wait=self.max_wait * 1000)
+
+    @property
+    def engine(self):
+        """The engine given at construction, else the process-wide one"""
+        return self._engine or get_engine()
+
+    def submit(self, checkpoint_dir, img, device_t='/device:CPU:0'):
+        """Queue one image, return a Future resolving to its styled image"""
+        future = Future()
+        key = (checkpoint_dir, device_t, img.shape)
+        with self._cond:
+            assert not self._closed, 'scheduler is closed'
+            self.requests += 1
+            if key not in self._pending:
+                self._pending[key] = []
+                self._deadlines[key] = time.time() + self.max_wait
+            self._pending[key].append((img, future))
+            self._cond.notify()
+        return future
+
+    def run(self, checkpoint_dir, img, device_t='/device:CPU:0'):
+        """Submit one image and block until it has been styled"""
+        return self.submit(checkpoint_dir, img, device_t).result()
+
+    def close(self):
+        """Flush queued requests and stop the dispatcher thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._executor.shutdown()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'requests': self.requests,
+                'batches': self.batches,
+                'queued': sum(len(p) for p in self._pending.values()),
+                'running': len(self._running),
+            }
+
+    def _next_batch(self):
+        """Wait until a group is full or has waited long enough, pop it
+
+        Groups with a batch still running are left to fill up.
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = [key for key in self._pending
+                         if key not in self._running]
+                for key in ready:
+                    requests = self._pending[key]
+                    limit = self._batch_limit(key)
+                    if (len(requests) >= limit or
+                            self._deadlines[key] <= now or self._closed):
+                        batch = requests[:limit]
+                        rest = requests[limit:]
+                        if rest:
+                            self._pending[key] = rest
+                            self._deadlines[key] = now + self.max_wait
+                        else:
+                            del self._pending[key]
+                            del self._deadlines[key]
+                        self._running.add(key)
+                        self.batches += 1
+                        return key, batch
+
+                if self._closed and not self._pending:
+                    return None, None
+                if ready:
+                    timeout = max(min(self._deadlines[key]
+                                      for key in ready) - now, 0)
+                    self._cond.wait(timeout)
+                else:
+                    self._cond.wait()
+
+    def _batch_limit(self, key):
+        """Images of this key's shape that can run together in the budget"""
+        return max(min(self.max_batch,
+                       tiling.images_per_batch(key[2], self.max_memory_mb)),
+                   1)
+
+    def _dispatch(self):
+        while True:
+            key, batch = self._next_batch()
+            if key is None:
+                return
+            self._executor.submit(self._run_batch, key, batch)
+
+    def _run_batch(self, key, batch):
+        checkpoint_dir, device_t, _ = key
+        futures = [future for _, future in batch]
+        try:
+            X = np.stack([img for img, _ in batch]).astype(np.float32)
+            _preds = self.engine.run(checkpoint_dir, X, device_t)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for j, future in enumerate(futures):
+                future.set_result(_preds[j])
+        finally:
+            with self._cond:
+                self._running.discard(key)
+                self._cond.notify()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide BatchScheduler"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = BatchScheduler()
+        return _scheduler
+
+
+def benchmark(checkpoint_dir, clients=8, requests=64, size=512,
+              device_t='/device:CPU:0', max_wait_ms=MAX_WAIT_MS,
+              max_batch=MAX_BATCH):
+    """Compare images/sec for unbatched and micro-batched concurrent calls"""
+    engine = get_engine()
+    img = np.random.uniform(0, 255, (size, size, 3)).astype(np.float32)
+    engine.run(checkpoint_dir, img[np.newaxis], device_t)  # warm up
+
+    def timed(style_one):
+        executor = ThreadPoolExecutor(clients)
+        start_time = time.time()
+        list(executor.map(lambda _: style_one(), range(requests)))
+        executor.shutdown()
+        return requests / (time.time() - start_time)
+
+    unbatched = timed(
+        lambda: engine.run(checkpoint_dir, img[np.newaxis], device_t))
+
+    scheduler = BatchScheduler(engine, max_wait_ms, max_batch)
+    batched = timed(lambda: scheduler.run(checkpoint_dir, img, device_t))
+    scheduler.close()
+
+    cores = multiprocessing.cpu_count()
+    return {
+        'cores': cores,
+        'clients': clients,
+        'requests': requests,
+        'size': size,
+        'maxWaitMs': max_wait_ms,
+        'maxBatch': max_batch,
+        'unbatchedImagesPerSec': unbatched,
+        'batchedImagesPerSec': batched,
+        'unbatchedImagesPerSecPerCore': unbatched / cores,
+        'batchedImagesPerSecPerCore': batched / cores,
+        'batches': scheduler.batches,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('checkpoint_dir')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--device', default='/device:CPU:0')
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    args = parser.parse_args()
+
+    result = benchmark(args.checkpoint_dir, args.clients, args.requests,
+                       args.size, args.device, args.max_wait_ms,
+                       args.max_batch)
+    for name in sorted(result):
+        print('%s: %s' % (name, result[name]))
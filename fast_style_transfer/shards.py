@@ -0,0 +1,209 @@
+"""Preprocessed content images in memory-mapped .npy shards
+
+Training decodes and resizes every content image on every epoch of every
+style. Doing it once instead, the content set is written as 256x256 uint8
+arrays into large .npy shards with a JSON index, which optimize() maps
+straight from disk and reads in shuffled batches:
+
+    $ python fast_style_transfer/shards.py data/train2014 data/shards
+
+then pass ContentShards('data/shards') to optimize() as content_targets.
+Features computed from the images, such as optimize()'s VGG content
+features, can be stored alongside the shards under a key and read back in
+step with the images.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import os
+import shutil
+from utils import get_img, list_files
+
+CONTENT_SHAPE = (256, 256, 3)
+# 2048 images of 256x256x3 make shards of about 400MB
+SHARD_IMAGES = 2048
+INDEX_NAME = 'index.json'
+SHARD_NAME = 'shard-{:05d}.npy'
+FEATURES_NAME = 'features-{key}'
+# feature shards are float16, so values are clipped to its range
+FEATURES_DTYPE = np.float16
+
+
+def _load(img_p):
+    return get_img(img_p, CONTENT_SHAPE)
+
+
+def write_shards(paths, out_dir, shard_images=SHARD_IMAGES,
+                 processes=multiprocessing.cpu_count()):
+    """Resize the images at paths into shards in out_dir, return the index
+
+    Images are decoded in a process pool and written in order, so image i
+    of the index is paths[i]. The index is written last; a directory
+    without one is an interrupted run.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    index = {'shape': list(CONTENT_SHAPE), 'sources': list(paths),
+             'shards': []}
+    decoders = multiprocessing.Pool(processes)
+    try:
+        imgs = decoders.imap(_load, paths, chunksize=16)
+        for pos in range(0, len(paths), shard_images):
+            count = min(shard_images, len(paths) - pos)
+            name = SHARD_NAME.format(len(index['shards']))
+            shard = np.lib.format.open_memmap(
+                os.path.join(out_dir, name), mode='w+', dtype=np.uint8,
+                shape=(count,) + CONTENT_SHAPE)
+            for j in range(count):
+                shard[j] = next(imgs)
+            shard.flush()
+            del shard
+            index['shards'].append({'file': name, 'count': count})
+            print('%s: %d images' % (name, count))
+    finally:
+        decoders.terminate()
+        decoders.join()
+
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+class ContentShards(object):
+    """Read-only, memory-mapped view of a directory written by write_shards
+
+    Nothing is read up front; pages are faulted in as batches touch them
+    and stay in the OS page cache for the next epoch or style.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.features = None
+        with open(os.path.join(shard_dir, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.shape = tuple(self.index['shape'])
+        self.shards = [np.load(os.path.join(shard_dir, shard['file']),
+                               mmap_mode='r')
+                       for shard in self.index['shards']]
+        # global index of each shard's first image
+        self.offsets = np.cumsum([0] + [len(shard)
+                                        for shard in self.shards])
+
+    def __repr__(self):
+        return '<ContentShards shard_dir="{dir}" images={images}>'.format(
+            dir=self.shard_dir, images=len(self))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get(self, indices):
+        """Images at the given global indices as one float32 batch"""
+        return self._gather(self.shards, indices)
+
+    def get_features(self, indices):
+        """Loaded features of the given images as one float32 batch"""
+        return self._gather(self.features, indices)
+
+    def batches(self, batch_size, epochs=1, shuffle=True, seed=None,
+                with_features=False):
+        """Yield float32 batches, reshuffled every epoch
+
+        With with_features, (images, features) pairs are yielded instead;
+        load_features must have been called first. A trailing partial
+        batch is dropped, as optimize() trims the training set to a whole
+        number of batches.
+        """
+        random = np.random.RandomState(seed)
+        num_examples = len(self) - len(self) % batch_size
+        for _ in range(epochs):
+            order = (random.permutation(len(self)) if shuffle else
+                     np.arange(len(self)))
+            for pos in range(0, num_examples, batch_size):
+                # reading in file order keeps the mapped pages sequential
+                indices = np.sort(order[pos:pos + batch_size])
+                if with_features:
+                    yield self.get(indices), self.get_features(indices)
+                else:
+                    yield self.get(indices)
+
+    def get_features_dir(self, key):
+        return os.path.join(self.shard_dir, FEATURES_NAME.format(key=key))
+
+    def has_features(self, key):
+        return os.path.isfile(os.path.join(self.get_features_dir(key),
+                                           INDEX_NAME))
+
+    def write_features(self, key, compute, batch_size=16):
+        """Store compute(images) for every image under key
+
+        compute maps a float32 batch of images to a batch of features.
+        Its outputs are written as float16 shards matching the image
+        shards one to one, under a temporary name until complete.
+        """
+        features_dir = self.get_features_dir(key)
+        tmp_dir = '{dir}.{pid}'.format(dir=features_dir, pid=os.getpid())
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        limit = np.finfo(FEATURES_DTYPE).max
+        for shard_id, shard in enumerate(self.shards):
+            features = None
+            for pos in range(0, len(shard), batch_size):
+                batch = compute(shard[pos:pos + batch_size].astype(
+                    np.float32))
+                if features is None:
+                    features = np.lib.format.open_memmap(
+                        os.path.join(tmp_dir, SHARD_NAME.format(shard_id)),
+                        mode='w+', dtype=FEATURES_DTYPE,
+                        shape=(len(shard),) + batch.shape[1:])
+                features[pos:pos + len(batch)] = np.clip(batch, -limit,
+                                                         limit)
+            features.flush()
+            del features
+            print('%s/%s' % (FEATURES_NAME.format(key=key),
+                             SHARD_NAME.format(shard_id)))
+
+        with open(os.path.join(tmp_dir, INDEX_NAME), 'w') as f:
+            json.dump({'key': key, 'shape': list(batch.shape[1:])}, f)
+        if os.path.isdir(features_dir):
+            shutil.rmtree(features_dir)
+        os.rename(tmp_dir, features_dir)
+
+    def load_features(self, key):
+        """Memory-map the features stored under key, return their shape"""
+        features_dir = self.get_features_dir(key)
+        with open(os.path.join(features_dir, INDEX_NAME)) as f:
+            shape = tuple(json.load(f)['shape'])
+        self.features = [np.load(os.path.join(features_dir,
+                                              SHARD_NAME.format(shard_id)),
+                                 mmap_mode='r')
+                         for shard_id in range(len(self.shards))]
+        return shape
+
+    def _gather(self, shards, indices):
+        batch = np.empty((len(indices),) + shards[0].shape[1:],
+                         dtype=np.float32)
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        for j, (i, shard_id) in enumerate(zip(indices, shard_ids)):
+            batch[j] = shards[shard_id][i - self.offsets[shard_id]]
+        return batch
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('content_dir')
+    parser.add_argument('shard_dir')
+    parser.add_argument('--shard-images', type=int, default=SHARD_IMAGES)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    paths = [os.path.join(args.content_dir, name)
+             for name in sorted(list_files(args.content_dir))]
+    index = write_shards(paths, args.shard_dir, args.shard_images,
+                         args.processes)
+    print('%d images in %d shards' % (len(index['sources']),
+                                      len(index['shards'])))
@@ -0,0 +1,102 @@
+"""Overlapping tiles for styling large images under a memory budget
+
+transform.net activations grow with pixel count, so images too large for the
+budget are split into overlapping square tiles, styled as a batch and
+stitched back together. Overlapping regions are blended with linear
+feathering so the per-tile instance normalisation does not leave hard seams.
+"""
+
+import os
+import numpy as np
+
+MAX_MEMORY_MB = float(os.environ.get('DEEP_PAINT_INFERENCE_MEMORY_MB', 1024))
+# Conservative estimate of transform.net's peak activation memory per input
+# pixel: several live 32-channel float32 maps at full resolution plus the
+# instance-norm temporaries.
+BYTES_PER_PIXEL = 1024
+TILE_OVERLAP = 32
+MIN_TILE_SIZE = 128
+# the two stride-2 convolutions make the output a multiple of 4 pixels
+TILE_MULTIPLE = 4
+
+
+def fits_budget(shape, max_memory_mb, batch_size=1):
+    """Check whether a batch of images of this shape fits in the budget"""
+    rows, cols = shape[0], shape[1]
+    return batch_size * rows * cols * BYTES_PER_PIXEL <= max_memory_mb * 2**20
+
+
+def images_per_batch(shape, max_memory_mb):
+    """How many images of this shape fit in one sess.run, 0 if none do"""
+    return int(max_memory_mb * 2**20 // (shape[0] * shape[1] *
+                                         BYTES_PER_PIXEL))
+
+
+def tile_size_for_budget(max_memory_mb, overlap=TILE_OVERLAP):
+    """Largest tile edge whose activations fit in max_memory_mb"""
+    edge = int((max_memory_mb * 2**20 / float(BYTES_PER_PIXEL)) ** 0.5)
+    edge -= edge % TILE_MULTIPLE
+    return max(edge, MIN_TILE_SIZE, 2 * overlap + TILE_MULTIPLE)
+
+
+def tiles_per_batch(tile_size, max_memory_mb):
+    """How many tiles can be run through one sess.run within the budget"""
+    return max(images_per_batch((tile_size, tile_size), max_memory_mb), 1)
+
+
+def pad(img, shape):
+    """Pad an HxWxC image at the bottom and right up to shape's rows/cols"""
+    rows, cols = img.shape[:2]
+    pad_rows, pad_cols = max(shape[0] - rows, 0), max(shape[1] - cols, 0)
+    if not (pad_rows or pad_cols):
+        return img
+    return np.pad(img, ((0, pad_rows), (0, pad_cols), (0, 0)),
+                  mode='reflect' if min(rows, cols) > 1 else 'edge')
+
+
+def _starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def split(img, tile_size, overlap=TILE_OVERLAP):
+    """Cut an HxWxC image into overlapping tile_size squares
+
+    Returns the (N, tile_size, tile_size, C) tiles and the (row, col) origin
+    of each. Images smaller than a tile are reflect-padded.
+    """
+    img = pad(img, (tile_size, tile_size))
+    origins = [(r, c) for r in _starts(img.shape[0], tile_size, overlap)
+               for c in _starts(img.shape[1], tile_size, overlap)]
+    tiles = np.stack([img[r:r + tile_size, c:c + tile_size]
+                      for r, c in origins])
+    return tiles, origins
+
+
+def _feather(tile_size, overlap):
+    """Per-pixel blend weights ramping up across the overlap margin"""
+    ramp = np.ones(tile_size, dtype=np.float32)
+    if overlap > 0:
+        edge = np.linspace(1.0 / (overlap + 1), 1.0, overlap, endpoint=False)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge[::-1]
+    return np.outer(ramp, ramp)[:, :, np.newaxis]
+
+
+def blend(tiles, origins, shape, overlap=TILE_OVERLAP):
+    """Stitch styled tiles back into an image of the given HxWxC shape"""
+    tile_size = tiles.shape[1]
+    rows = max(shape[0], tile_size)
+    cols = max(shape[1], tile_size)
+    out = np.zeros((rows, cols, tiles.shape[3]), dtype=np.float32)
+    weights = np.zeros((rows, cols, 1), dtype=np.float32)
+    feather = _feather(tile_size, overlap)
+    for tile, (r, c) in zip(tiles, origins):
+        out[r:r + tile_size, c:c + tile_size] += tile * feather
+        weights[r:r + tile_size, c:c + tile_size] += feather
+    out /= weights
+    return out[:shape[0], :shape[1]]
@@ -1,25 +1,75 @@
+import os
 import tensorflow as tf
 
 WEIGHTS_INIT_STDEV = .1
-
-
-def net(image):
-    conv1 = _conv_layer(image, 32, 9, 1)
-    conv2 = _conv_layer(conv1, 64, 3, 2)
-    conv3 = _conv_layer(conv2, 128, 3, 2)
-    resid1 = _residual_block(conv3, 3)
-    resid2 = _residual_block(resid1, 3)
-    resid3 = _residual_block(resid2, 3)
-    resid4 = _residual_block(resid3, 3)
-    resid5 = _residual_block(resid4, 3)
-    conv_t1 = _conv_tranpose_layer(resid5, 64, 3, 2)
-    conv_t2 = _conv_tranpose_layer(conv_t1, 32, 3, 2)
+# filters in the first layer; the downsampled layers and residual blocks use
+# 2x and 4x as many
+WIDTH = 32
+RESIDUAL_BLOCKS = 5
+# named architectures, the lite one trades some quality for CPU latency
+VARIANTS = {
+    'full': {'width': WIDTH, 'residual_blocks': RESIDUAL_BLOCKS},
+    'lite': {'width': 16, 'residual_blocks': 3},
+}
+
+
+def net(image, width=WIDTH, residual_blocks=RESIDUAL_BLOCKS):
+    """Build the transform network
+
+    The image may have a fully static shape (training) or unknown batch,
+    height and width, e.g. (None, None, None, 3), so a single restored graph
+    can serve images of any resolution.
+    """
+    conv1 = _conv_layer(image, width, 9, 1)
+    conv2 = _conv_layer(conv1, width * 2, 3, 2)
+    resid = _conv_layer(conv2, width * 4, 3, 2)
+    for _ in range(residual_blocks):
+        resid = _residual_block(resid, 3)
+    conv_t1 = _conv_tranpose_layer(resid, width * 2, 3, 2)
+    conv_t2 = _conv_tranpose_layer(conv_t1, width, 3, 2)
     conv_t3 = _conv_layer(conv_t2, 3, 9, 1, relu=False)
     preds = tf.nn.tanh(conv_t3) * 150 + 255.0 / 2
 
     return preds
 
 
+def read_config(checkpoint_dir):
+    """Width and residual block count of a saved transform.net
+
+    Every layer saves a weight, shift and scale variable and the first
+    weight's output channels is the width, so the architecture can be read
+    back from any checkpoint, including ones saved before it was
+    configurable.
+    """
+    if os.path.isdir(checkpoint_dir):
+        checkpoint_dir = tf.train.latest_checkpoint(checkpoint_dir)
+    shapes = tf.train.NewCheckpointReader(
+        checkpoint_dir).get_variable_to_shape_map()
+    # optimizer slots are saved as Variable_n/Adam alongside the weights
+    layers = len([name for name in shapes
+                  if name.startswith('Variable') and '/' not in name]) // 3
+    return {'width': shapes['Variable'][3],
+            'residual_blocks': (layers - 6) // 2}
+
+
+def count_flops(rows, cols, width=WIDTH, residual_blocks=RESIDUAL_BLOCKS):
+    """Multiply-add FLOPs of one forward pass over a rows x cols image"""
+    def conv(rows, cols, filter_size, in_channels, out_channels):
+        return 2 * filter_size ** 2 * in_channels * out_channels * rows * cols
+
+    half, quarter = (rows / 2.0, cols / 2.0), (rows / 4.0, cols / 4.0)
+    flops = conv(rows, cols, 9, 3, width)
+    flops += conv(half[0], half[1], 3, width, width * 2)
+    flops += conv(quarter[0], quarter[1], 3, width * 2, width * 4)
+    flops += 2 * residual_blocks * conv(quarter[0], quarter[1], 3,
+                                        width * 4, width * 4)
+    # a transposed convolution does the work of one at its input size
+    flops += conv(quarter[0], quarter[1], 3, width * 4, width * 2)
+    flops += conv(half[0], half[1], 3, width * 2, width)
+    flops += conv(rows, cols, 9, width, 3)
+    return int(flops)
+
+
 def _conv_layer(net, num_filters, filter_size, strides, relu=True):
     weights_init = _conv_init_vars(net, num_filters, filter_size)
     strides_shape = [1, strides, strides, 1]
@@ -36,22 +86,29 @@ def _conv_tranpose_layer(net, num_filters, filter_size, strides):
                                    transpose=True)
 
     batch_size, rows, cols, in_channels = [i.value for i in net.get_shape()]
-    new_rows, new_cols = int(rows * strides), int(cols * strides)
-    # new_shape = #tf.pack([tf.shape(net)[0], new_rows, new_cols, num_filters])
-
-    new_shape = [batch_size, new_rows, new_cols, num_filters]
+    if None in (batch_size, rows, cols):
+        # inference mode: the input shape is only known when the graph runs
+        dynamic_shape = tf.shape(net)
+        new_shape = [dynamic_shape[0], dynamic_shape[1] * strides,
+                     dynamic_shape[2] * strides, num_filters]
+    else:
+        new_rows, new_cols = int(rows * strides), int(cols * strides)
+        new_shape = [batch_size, new_rows, new_cols, num_filters]
     tf_shape = tf.stack(new_shape)
     strides_shape = [1, strides, strides, 1]
 
     net = tf.nn.conv2d_transpose(net, weights_init, tf_shape, strides_shape,
                                  padding='SAME')
+    net.set_shape([batch_size, None if rows is None else rows * strides,
+                   None if cols is None else cols * strides, num_filters])
     net = _instance_norm(net)
     return tf.nn.relu(net)
 
 
 def _residual_block(net, filter_size=3):
-    tmp = _conv_layer(net, 128, filter_size, 1)
-    return net + _conv_layer(tmp, 128, filter_size, 1, relu=False)
+    channels = net.get_shape()[3].value
+    tmp = _conv_layer(net, channels, filter_size, 1)
+    return net + _conv_layer(tmp, channels, filter_size, 1, relu=False)
 
 
 def _instance_norm(net, train=True):
@@ -61,8 +118,10 @@ def _instance_norm(net, train=True):
     shift = tf.Variable(tf.zeros(var_shape))
     scale = tf.Variable(tf.ones(var_shape))
     epsilon = 1e-3
-    normalized = (net - mu) / (sigma_sq + epsilon)**(0.5)
-    return scale * normalized + shift
+    # scale * (net - mu) / sqrt(sigma_sq + epsilon) + shift, with scale and
+    # shift folded into one per-channel multiply-add over the feature map
+    multiplier = scale * tf.rsqrt(sigma_sq + epsilon)
+    return net * multiplier + (shift - mu * multiplier)
 
 
 def _conv_init_vars(net, out_channels, filter_size, transpose=False):
@@ -1,6 +1,11 @@
 import scipy.misc
 import numpy as np
 import os
+from io import BytesIO
+from PIL import Image
+
+IMAGE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF',
+                 'tif': 'TIFF', 'tga': 'TGA'}
 
 
 def save_img(out_path, img):
@@ -8,6 +13,20 @@ def save_img(out_path, img):
     scipy.misc.imsave(out_path, img)
 
 
+def decode_img(data):
+    """Decode encoded image bytes into an RGB array"""
+    return scipy.misc.imread(BytesIO(data), mode='RGB')
+
+
+def encode_img(img, file_extension='jpg'):
+    """Encode an RGB array as image bytes of the given file type"""
+    img = np.clip(img, 0, 255).astype(np.uint8)
+    output = BytesIO()
+    scipy.misc.toimage(img).save(output, IMAGE_FORMATS.get(
+        file_extension.lower(), file_extension.upper()))
+    return output.getvalue()
+
+
 def scale_img(style_path, style_scale):
     scale = float(style_scale)
     o0, o1, o2 = scipy.misc.imread(style_path, mode='RGB').shape
@@ -26,6 +45,24 @@ def get_img(src, img_size=False):
     return img
 
 
+def get_img_shape(src):
+    """Shape get_img would return, read from the image header only"""
+    image = Image.open(src)
+    cols, rows = image.size
+    image.close()
+    return (rows, cols, 3)
+
+
+def shrink_img(img, max_edge):
+    """Scale an image down so its longest edge is at most max_edge"""
+    rows, cols = img.shape[:2]
+    scale = float(max_edge) / max(rows, cols)
+    if scale >= 1:
+        return img
+    new_shape = (max(int(rows * scale), 1), max(int(cols * scale), 1), 3)
+    return scipy.misc.imresize(img, new_shape)
+
+
 def exists(p, msg):
     assert os.path.exists(p), msg
 
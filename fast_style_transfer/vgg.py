@@ -1,44 +1,49 @@
 # Copyright (c) 2015-2016 Anish Athalye. Released under GPLv3.
 
+import hashlib
+import os
+import shutil
+import threading
 import tensorflow as tf
 import numpy as np
 import scipy.io
 
 
 MEAN_PIXEL = np.array([123.68, 116.779, 103.939])
+# converted weights are cached in a directory next to the .mat file
+WEIGHTS_SUFFIX = '.weights'
+LAYERS = (
+    'conv1_1', 'relu1_1', 'conv1_2', 'relu1_2', 'pool1',
 
+    'conv2_1', 'relu2_1', 'conv2_2', 'relu2_2', 'pool2',
 
-def net(data_path, input_image):
-    layers = (
-        'conv1_1', 'relu1_1', 'conv1_2', 'relu1_2', 'pool1',
+    'conv3_1', 'relu3_1', 'conv3_2', 'relu3_2', 'conv3_3',
+    'relu3_3', 'conv3_4', 'relu3_4', 'pool3',
 
-        'conv2_1', 'relu2_1', 'conv2_2', 'relu2_2', 'pool2',
+    'conv4_1', 'relu4_1', 'conv4_2', 'relu4_2', 'conv4_3',
+    'relu4_3', 'conv4_4', 'relu4_4', 'pool4',
 
-        'conv3_1', 'relu3_1', 'conv3_2', 'relu3_2', 'conv3_3',
-        'relu3_3', 'conv3_4', 'relu3_4', 'pool3',
+    'conv5_1', 'relu5_1', 'conv5_2', 'relu5_2', 'conv5_3',
+    'relu5_3', 'conv5_4', 'relu5_4'
+)
 
-        'conv4_1', 'relu4_1', 'conv4_2', 'relu4_2', 'conv4_3',
-        'relu4_3', 'conv4_4', 'relu4_4', 'pool4',
 
-        'conv5_1', 'relu5_1', 'conv5_2', 'relu5_2', 'conv5_3',
-        'relu5_3', 'conv5_4', 'relu5_4'
-    )
+def net(data_path, input_image, last_layer=LAYERS[-1], after_layer=None):
+    """VGG-19 layers by name, up to and including last_layer
 
-    data = scipy.io.loadmat(data_path)
-    # mean = data['normalization'][0][0][0]
-    # mean_pixel = np.mean(mean, axis=(0, 1))
-    weights = data['layers'][0]
+    With after_layer, input_image is that layer's output and only the
+    layers following it are built, so a truncated net can be continued.
+    """
+    weights = load_weights(data_path)
+    first = LAYERS.index(after_layer) + 1 if after_layer else 0
+    layers = LAYERS[first:LAYERS.index(last_layer) + 1]
 
     net = {}
     current = input_image
-    for i, name in enumerate(layers):
+    for name in layers:
         kind = name[:4]
         if kind == 'conv':
-            kernels, bias = weights[i][0][0][0][0]
-            # matconvnet: weights are [width, height, in_channels, out_channels]
-            # tensorflow: weights are [height, width, in_channels, out_channels]
-            kernels = np.transpose(kernels, (1, 0, 2, 3))
-            bias = bias.reshape(-1)
+            kernels, bias = weights[name]
             current = _conv_layer(current, kernels, bias)
         elif kind == 'relu':
             current = tf.nn.relu(current)
@@ -50,6 +55,87 @@ def net(data_path, input_image):
     return net
 
 
+def deepest(layers):
+    """Whichever of the named layers comes last in the net"""
+    return max(layers, key=LAYERS.index)
+
+
+_weights = {}
+_weights_lock = threading.Lock()
+
+
+def load_weights(data_path):
+    """Kernels and biases by conv layer name, shared within the process
+
+    The first call converts the MatConvNet .mat file into one .npy file per
+    array, kernels already transposed for tensorflow; every later call,
+    in this process or another, memory-maps those instead of parsing the
+    .mat again.
+    """
+    data_path = os.path.abspath(data_path)
+    with _weights_lock:
+        if data_path not in _weights:
+            cache_dir = data_path + WEIGHTS_SUFFIX
+            if not _is_fresh(data_path, cache_dir):
+                _convert_weights(data_path, cache_dir)
+            _weights[data_path] = dict(
+                (name, (_load_array(cache_dir, name + '.kernels.npy'),
+                        _load_array(cache_dir, name + '.bias.npy')))
+                for name in LAYERS if name[:4] == 'conv')
+        return _weights[data_path]
+
+
+_hashes = {}
+
+
+def weights_hash(data_path):
+    """SHA-1 of the .mat file, identifying the weights features came from"""
+    data_path = os.path.abspath(data_path)
+    key = (data_path, os.path.getmtime(data_path))
+    with _weights_lock:
+        if key not in _hashes:
+            sha1 = hashlib.sha1()
+            with open(data_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(chunk)
+            _hashes[key] = sha1.hexdigest()
+        return _hashes[key]
+
+
+def _load_array(cache_dir, filename):
+    return np.load(os.path.join(cache_dir, filename), mmap_mode='r')
+
+
+def _is_fresh(data_path, cache_dir):
+    return (os.path.isdir(cache_dir) and
+            os.path.getmtime(cache_dir) >= os.path.getmtime(data_path))
+
+
+def _convert_weights(data_path, cache_dir):
+    data = scipy.io.loadmat(data_path)
+    # mean = data['normalization'][0][0][0]
+    # mean_pixel = np.mean(mean, axis=(0, 1))
+    weights = data['layers'][0]
+
+    # written under a temporary name so readers never see a partial cache
+    tmp_dir = '{dir}.{pid}'.format(dir=cache_dir, pid=os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for i, name in enumerate(LAYERS):
+        if name[:4] != 'conv':
+            continue
+        kernels, bias = weights[i][0][0][0][0]
+        # matconvnet: weights are [width, height, in_channels, out_channels]
+        # tensorflow: weights are [height, width, in_channels, out_channels]
+        np.save(os.path.join(tmp_dir, name + '.kernels.npy'),
+                np.ascontiguousarray(np.transpose(kernels, (1, 0, 2, 3))))
+        np.save(os.path.join(tmp_dir, name + '.bias.npy'), bias.reshape(-1))
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
 def _conv_layer(input, weights, bias):
     conv = tf.nn.conv2d(input, tf.constant(weights), strides=(1, 1, 1, 1),
                         padding='SAME')
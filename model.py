@@ -1,19 +1,70 @@
 """Models and database functions for deep-paint"""
 
-from datetime import datetime
+import numpy as np
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
-from os import remove, path, getcwd
+from io import BytesIO
+from os import remove, path, getcwd, environ
 from PIL import Image as PILImage
-from time import time
+from threading import Lock
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from fast_style_transfer.evaluate import ffwd_to_img
+# tensorflow is only imported once a style is run, see backend.py
+from fast_style_transfer.backend import get_backend
+from fast_style_transfer.metrics import stage_timer
+from fast_style_transfer.utils import IMAGE_FORMATS
+from output_cache import file_digest, get_output_cache, make_key
 
 db = SQLAlchemy()
 
 FILESTORE_PATH = '/static/'
 ALLOWED_EXTENSIONS = set(['gif', 'jpg', 'jpeg', 'png', 'tif', 'tga'])
 BASEPATH = getcwd()
+# uploads larger than this are shrunk; inference tiles anything that does not
+# fit in DEEP_PAINT_INFERENCE_MEMORY_MB, so this can safely be raised
+MAX_IMAGE_EDGE = int(environ.get('DEEP_PAINT_MAX_IMAGE_EDGE', 1024))
+# low resolution tier rendered inline while the full render is queued
+PREVIEW_EDGE = int(environ.get('DEEP_PAINT_PREVIEW_EDGE', 320))
+PREVIEW_PREFIX = 'preview_'
+# uploads are styled right after they are saved, so their decoded pixels are
+# kept for a while to skip reading the file back
+DECODED_IMAGES = int(environ.get('DEEP_PAINT_DECODED_IMAGES', 8))
+# previews are latency bound and always use a style's lite network when it
+# has one; full renders switch to it once this many jobs are queued (0 never)
+LITE_QUEUE_DEPTH = int(environ.get('DEEP_PAINT_LITE_QUEUE_DEPTH', 16))
+# a job running for longer than this is taken to have lost its worker, to an
+# OOM kill or a restart, and is claimed again
+JOB_TIMEOUT_SECONDS = int(environ.get('DEEP_PAINT_JOB_TIMEOUT_SECONDS', 900))
+
+
+# ========================================================================== #
+# Decoded images
+
+class DecodedImageCache(object):
+    """Small least recently used map of image_id to decoded RGB array"""
+
+    def __init__(self, max_images=DECODED_IMAGES):
+        self.max_images = max_images
+        self._arrays = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, image_id):
+        with self._lock:
+            img = self._arrays.pop(image_id, None)
+            if img is not None:
+                self._arrays[image_id] = img
+            return img
+
+    def put(self, image_id, img):
+        with self._lock:
+            self._arrays.pop(image_id, None)
+            self._arrays[image_id] = img
+            while len(self._arrays) > self.max_images:
+                self._arrays.popitem(last=False)
+
+
+decoded_images = DecodedImageCache()
 
 
 # ========================================================================== #
@@ -174,9 +225,30 @@ class Image(TimestampMixin, db.Model):
             filename = modifier + filename
         return self._path + filename
 
+    def get_array(self):
+        """Return the decoded RGB pixels, reading the file only if needed"""
+        img = decoded_images.get(self.image_id)
+        if img is None:
+            with stage_timer('decode'):
+                pil_image = PILImage.open(BASEPATH + self.get_path())
+                img = np.asarray(pil_image.convert('RGB'))
+                pil_image.close()
+            decoded_images.put(self.image_id, img)
+        return img
+
+    def get_best_path(self):
+        """Return the highest resolution tier of this image that exists"""
+        if self.styled_image and not self.styled_image.has_full:
+            return self.get_path(PREVIEW_PREFIX)
+        return self.get_path()
+
     @classmethod
     def create(cls, image_file, user=None, is_public=True, resize=True):
-        """Add an image to the database and save the image file"""
+        """Add an image to the database and save the image file
+
+        The upload is decoded once, resized in memory and written once; its
+        pixels are kept in decoded_images for the styling that follows.
+        """
         image = cls(file_extension=cls.get_file_extension(image_file.filename))
         if user:
             image.user = user
@@ -185,15 +257,35 @@ class Image(TimestampMixin, db.Model):
         db.session.add(image)
         db.session.commit()
 
-        if path.isfile(BASEPATH + image.get_path()):
-            remove(BASEPATH + image.get_path())
-
-        image_file.save(BASEPATH + image.get_path())
-        if resize:
-            cls.resize_image(BASEPATH + image.get_path())
+        data = image_file.read()
+        pil_image = PILImage.open(BytesIO(data))
+        if resize and cls.resize_image(pil_image):
+            # by extension, as before: pillow opens some camera JPEGs as
+            # MPO, which it cannot write
+            output = BytesIO()
+            pil_image.save(output, IMAGE_FORMATS.get(
+                image.file_extension, image.file_extension.upper()))
+            data = output.getvalue()
+
+        cls.write_file(image.get_path(), data)
+        decoded_images.put(image.image_id,
+                           np.asarray(pil_image.convert('RGB')))
+        pil_image.close()
 
         return image
 
+    @staticmethod
+    def write_file(file_path, data):
+        """Write encoded image bytes to a path under BASEPATH
+
+        Any existing file is unlinked first, it may be a hard link into the
+        output cache.
+        """
+        if path.isfile(BASEPATH + file_path):
+            remove(BASEPATH + file_path)
+        with open(BASEPATH + file_path, 'wb') as f:
+            f.write(data)
+
     @staticmethod
     def is_allowed_file(filename):
         """Verify the file is an image"""
@@ -205,11 +297,12 @@ class Image(TimestampMixin, db.Model):
         return filename.rsplit('.', 1)[1].lower()
 
     @staticmethod
-    def resize_image(image_path, size=(1024, 1024)):
-        image = PILImage.open(image_path)
-        image.thumbnail(size, PILImage.LANCZOS)
-        image.save(image_path)
-        image.close()
+    def resize_image(pil_image, size=(MAX_IMAGE_EDGE, MAX_IMAGE_EDGE)):
+        """Shrink a PIL image in place, return whether it was resized"""
+        if pil_image.size[0] <= size[0] and pil_image.size[1] <= size[1]:
+            return False
+        pil_image.thumbnail(size, PILImage.LANCZOS)
+        return True
 
 
 class SourceImage(db.Model):
@@ -248,6 +341,16 @@ class SourceImage(db.Model):
     def get_path(self):
         return self.image.get_path()
 
+    def get_cache_keys(self, styles, variants=None):
+        """Output cache keys for styling this image with each style"""
+        source_digest = file_digest(BASEPATH + self.get_path())
+        rows, cols = self.image.get_array().shape[:2]
+        output_size = (cols, rows)
+        variants = variants or [Style.FULL] * len(styles)
+        return [make_key(source_digest, style.style_id,
+                         style.get_checkpoint_version(variant), output_size)
+                for style, variant in zip(styles, variants)]
+
     @classmethod
     def create(cls, image_file, user, title='', description=''):
         image = Image.create(image_file, user)
@@ -266,11 +369,21 @@ class StyledImage(db.Model):
         source_image_id  INT REFERENCES source_images
         style_id         INT REFERENCES styles
 
+    Optional fields:
+        style_job_id     INT REFERENCES style_jobs
+        has_preview      BOOLEAN
+        has_full         BOOLEAN
+
     Additional attributes:
         image            Image object
         source_image     SourceImage object
         style            Style object
+        style_job        StyleJob object
         user             User object
+
+    Resolution tiers:
+        preview          {root_path}/image/preview_{filename}
+        full             {root_path}/image/{filename}
     """
 
     __tablename__ = 'styled_images'
@@ -285,45 +398,169 @@ class StyledImage(db.Model):
                                 nullable=False)
     style_id = db.Column(db.Integer, db.ForeignKey('styles.style_id'),
                          nullable=False)
+    style_job_id = db.Column(db.Integer,
+                             db.ForeignKey('style_jobs.style_job_id'))
+    has_preview = db.Column(db.Boolean, default=False, nullable=False)
+    has_full = db.Column(db.Boolean, default=True, nullable=False)
 
     image = db.relationship('Image', lazy='joined', uselist=False)
 
     source_image = db.relationship('SourceImage', backref='styled_images')
     style = db.relationship('Style', backref='styled_images')
+    style_job = db.relationship('StyleJob', backref='styled_images')
 
     def __repr__(self):
         return '<StyledImage styled_image_id={id} path="{path}">'.format(
             id=self.styled_image_id, path=self.get_path())
 
     def get_path(self):
-        return self.image.get_path()
+        return self.image.get_best_path()
+
+    def get_tiers(self):
+        """Return the names of the resolution tiers that are ready"""
+        tiers = []
+        if self.has_preview:
+            tiers.append('preview')
+        if self.has_full:
+            tiers.append('full')
+        return tiers
 
     @classmethod
     def create(cls, source_image, style, testing=False):
+        return cls.create_many(source_image, [style], testing=testing)[0]
+
+    @classmethod
+    def create_preview(cls, source_image, style, style_job=None,
+                       testing=False):
+        """Style a low resolution preview now, leaving full res for later
+
+        The returned styled image has no full tier; queue a StyleJob with
+        it to render one.
+        """
         user = source_image.image.user
 
         image = Image(user=user, is_public=user.pref_is_public,
                       file_extension=source_image.image.file_extension)
         db.session.add(image)
-        db.session.commit()
-
-        if path.isfile(image.get_path()):
-            remove(image.get_path())
+        db.session.flush()
 
         if not testing:
-            # apply tensorflow style
-            start_time = time()
-            ffwd_to_img(source_image.get_path(), image.get_path(),
-                        style.get_path())
-            end_time = time()
-            print '-----> evaluation timing: ', (end_time - start_time)
-
-        styled_image = cls(image=image, source_image=source_image, style=style)
+            variant = style.choose_variant(latency_bound=True)
+            try:
+                Image.write_file(
+                    image.get_path(PREVIEW_PREFIX), get_backend().ffwd_bytes(
+                        source_image.image.get_array(),
+                        style.get_path(variant), image.file_extension,
+                        max_edge=PREVIEW_EDGE))
+            except Exception:
+                db.session.rollback()
+                raise
+
+        styled_image = cls(image=image, source_image=source_image, style=style,
+                           style_job=style_job, has_preview=True,
+                           has_full=False)
         db.session.add(styled_image)
-        db.session.commit()
+        cls._commit([style])
 
         return styled_image
 
+    @classmethod
+    def render_full(cls, styled_images, testing=False):
+        """Render the full resolution tier of previewed styled images"""
+        source_image = styled_images[0].source_image
+        assert all(styled_image.source_image == source_image
+                   for styled_image in styled_images)
+
+        if not testing:
+            cls._render(source_image,
+                        [styled_image.style for styled_image in styled_images],
+                        [styled_image.image.get_path()
+                         for styled_image in styled_images])
+
+        for styled_image in styled_images:
+            styled_image.has_full = True
+        cls._commit([styled_image.style for styled_image in styled_images])
+
+        return styled_images
+
+    @classmethod
+    def create_many(cls, source_image, styles, style_job=None,
+                    testing=False):
+        """Apply several styles to one source image
+
+        The source is decoded once for every style and all rows are
+        committed together, so either every styled image exists or none do.
+        Outputs already in the output cache are linked instead of restyled.
+        """
+        user = source_image.image.user
+
+        images = []
+        for style in styles:
+            image = Image(user=user, is_public=user.pref_is_public,
+                          file_extension=source_image.image.file_extension)
+            db.session.add(image)
+            images.append(image)
+        db.session.flush()
+
+        out_paths = [image.get_path() for image in images]
+        for out_path in out_paths:
+            if path.isfile(BASEPATH + out_path):
+                remove(BASEPATH + out_path)
+
+        if not testing:
+            cls._render(source_image, styles, out_paths)
+
+        styled_images = [cls(image=image, source_image=source_image,
+                             style=style, style_job=style_job)
+                         for image, style in zip(images, styles)]
+        db.session.add_all(styled_images)
+        cls._commit(styles)
+
+        return styled_images
+
+    @staticmethod
+    def _commit(styles):
+        """Commit the session, timed as the db_commit stage"""
+        checkpoint_dir = styles[0].get_path() if len(styles) == 1 else None
+        with stage_timer('db_commit', checkpoint_dir):
+            db.session.commit()
+
+    @staticmethod
+    def _render(source_image, styles, out_paths):
+        """Write each style's output, from the output cache where possible
+
+        Rolls back the session and removes partial outputs on failure.
+        """
+        variants = [style.choose_variant() for style in styles]
+        checkpoint_dirs = [style.get_path(variant)
+                           for style, variant in zip(styles, variants)]
+        cache_keys = source_image.get_cache_keys(styles, variants)
+        misses = [i for i, key in enumerate(cache_keys)
+                  if not get_output_cache().fetch(key,
+                                                  BASEPATH + out_paths[i])]
+
+        # apply tensorflow styles to the in-memory source
+        img = source_image.image.get_array()
+        try:
+            if len(misses) == 1:
+                Image.write_file(out_paths[misses[0]],
+                                 get_backend().ffwd_bytes(
+                                     img, checkpoint_dirs[misses[0]],
+                                     source_image.image.file_extension))
+            elif misses:
+                get_backend().ffwd_many(
+                    img, [out_paths[i] for i in misses],
+                    [checkpoint_dirs[i] for i in misses])
+        except Exception:
+            db.session.rollback()
+            for out_path in out_paths:
+                if path.isfile(BASEPATH + out_path):
+                    remove(BASEPATH + out_path)
+            raise
+
+        for i in misses:
+            get_output_cache().store(cache_keys[i], BASEPATH + out_paths[i])
+
 
 # ========================================================================== #
 # TFModels & Styles
@@ -381,6 +618,7 @@ class Style(db.Model):
         title          STRING(128)
         artist         STRING(128)
         description    STRING(700)
+        has_lite       BOOLEAN
 
     Additional attributes:
         style_id       SERIAL PRIMARY KEY
@@ -391,15 +629,23 @@ class Style(db.Model):
         users          List of User objects
 
     Filename:
-        {style_id}.ckpt
+        full           {style_id}.ckpt
+        lite           {style_id}.lite.ckpt
 
     Filepath:
         {root_path}/style/{filename}
+
+    The lite variant is a narrower, shallower transform.net trained for the
+    same style (see transform.VARIANTS); it is served when latency matters
+    more than quality.
     """
 
     __tablename__ = 'styles'
     _path = FILESTORE_PATH + 'style/'
 
+    FULL = 'full'
+    LITE = 'lite'
+
     style_id = db.Column(db.Integer, primary_key=True, autoincrement=True,
                          nullable=False)
     title = db.Column(db.String(128), default='', nullable=False)
@@ -409,6 +655,7 @@ class Style(db.Model):
                             nullable=False)
     image_id = db.Column(db.Integer, db.ForeignKey('images.image_id'),
                          nullable=False)
+    has_lite = db.Column(db.Boolean, default=False, nullable=False)
 
     tf_model = db.relationship('TFModel', backref='styles')
     image = db.relationship('Image', backref='styles')
@@ -417,25 +664,263 @@ class Style(db.Model):
         return '<Style style_id={id} title="{title}">'.format(
             id=self.style_id, title=self.title)
 
-    def get_path(self):
+    def get_path(self, variant=FULL):
+        if variant == self.LITE:
+            return self._path + '{id}.lite.ckpt'.format(id=self.style_id)
         return self._path + '{id}.ckpt'.format(id=self.style_id)
 
+    def get_variants(self):
+        """Network variants this style has checkpoints for"""
+        return [self.FULL, self.LITE] if self.has_lite else [self.FULL]
+
+    def choose_variant(self, latency_bound=False):
+        """Pick the network to serve a render with
+
+        The lite network is used for latency bound renders and, once
+        LITE_QUEUE_DEPTH jobs are waiting, for everything.
+        """
+        if not self.has_lite:
+            return self.FULL
+        if latency_bound or (LITE_QUEUE_DEPTH and
+                             StyleJob.count_active() >= LITE_QUEUE_DEPTH):
+            return self.LITE
+        return self.FULL
+
+    def get_checkpoint_version(self, variant=FULL):
+        """Changes whenever the checkpoint file is replaced"""
+        checkpoint_path = BASEPATH + self.get_path(variant)
+        version = '{mtime:.0f}-{size}'.format(
+            mtime=path.getmtime(checkpoint_path),
+            size=path.getsize(checkpoint_path))
+        if variant == self.LITE:
+            version = self.LITE + '-' + version
+        return version
+
+    @classmethod
+    def get_most_used(cls):
+        """All styles, those with the most styled images first"""
+        return (cls.query.outerjoin(StyledImage)
+                .group_by(cls.style_id)
+                .order_by(db.func.count(StyledImage.styled_image_id).desc(),
+                          cls.style_id)
+                .all())
+
     @classmethod
     def create(cls, style_file, image_file, tf_model, title='', artist='',
-               description=''):
+               description='', lite_style_file=None):
         image = Image.create(image_file)
         style = cls(tf_model=tf_model, image=image, title=title, artist=artist,
-                    description=description)
+                    description=description,
+                    has_lite=lite_style_file is not None)
         db.session.add(style)
         db.session.commit()
 
-        if path.isfile(BASEPATH + style.get_path()):
-            remove(BASEPATH + style.get_path())
-        style_file.save(BASEPATH + style.get_path())
+        files = [(style_file, cls.FULL)]
+        if lite_style_file is not None:
+            files.append((lite_style_file, cls.LITE))
+        for checkpoint_file, variant in files:
+            checkpoint_path = BASEPATH + style.get_path(variant)
+            if path.isfile(checkpoint_path):
+                remove(checkpoint_path)
+            checkpoint_file.save(checkpoint_path)
 
         return style
 
 
+# ========================================================================== #
+# Style Jobs
+
+class StyleJob(TimestampMixin, db.Model):
+    """Style job model
+
+    Queued request to apply one or more Styles to a SourceImage. Jobs are
+    picked up and run by worker.py so web requests never wait on tensorflow.
+
+    Jobs with preview_first render a low resolution preview of each style
+    ahead of every other job, then go back in the queue behind the jobs
+    already waiting for their full resolution render: the queue is ordered
+    by queued_at, which is reset when a job goes back.
+
+    Required fields:
+        source_image_id  INT REFERENCES source_images
+
+    Optional fields:
+        user_id          INT REFERENCES users
+        state            STRING(16) DEFAULT 'pending'
+        error            STRING(700)
+        preview_first    BOOLEAN DEFAULT False
+
+    Additional attributes:
+        style_job_id     SERIAL PRIMARY KEY
+        created_at       DATETIME DEFAULT datetime.utcnow
+        queued_at        DATETIME DEFAULT datetime.utcnow
+        started_at       DATETIME
+        finished_at      DATETIME
+        user             User object, whoever requested the job
+        source_image     SourceImage object
+        styles           List of Style objects
+        styled_images    List of StyledImage objects
+    """
+
+    __tablename__ = 'style_jobs'
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    style_job_id = db.Column(db.Integer, primary_key=True, autoincrement=True,
+                             nullable=False)
+    state = db.Column(db.String(16), default=PENDING, nullable=False,
+                      index=True)
+    error = db.Column(db.String(700), default='', nullable=False)
+    preview_first = db.Column(db.Boolean, default=False, nullable=False)
+    source_image_id = db.Column(db.Integer,
+                                db.ForeignKey('source_images.source_image_id'),
+                                nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'),
+                        index=True)
+    queued_at = db.Column(db.DateTime, default=datetime.utcnow,
+                          nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    user = db.relationship('User', backref='style_jobs')
+    source_image = db.relationship('SourceImage', backref='style_jobs')
+    styles = db.relationship('Style', secondary='style_job_styles',
+                             order_by='StyleJobStyle.position')
+
+    def __repr__(self):
+        return '<StyleJob style_job_id={id} state="{state}">'.format(
+            id=self.style_job_id, state=self.state)
+
+    @classmethod
+    def create(cls, source_image, styles, styled_images=None, user=None,
+               preview_first=False):
+        """Queue a job; styled_images are previews for it to render in full
+
+        user is whoever asked for it, which may not be the source image's
+        owner; per user limits count jobs by requester.
+        """
+        style_job = cls(source_image=source_image, user=user,
+                        preview_first=preview_first)
+        for styled_image in styled_images or []:
+            styled_image.style_job = style_job
+        db.session.add(style_job)
+        db.session.add_all([StyleJobStyle(style_job=style_job, style=style,
+                                          position=position)
+                            for position, style in enumerate(styles)])
+        db.session.commit()
+        return style_job
+
+    @classmethod
+    def count_active(cls, user_id=None, previews=False):
+        """Number of pending and running jobs, optionally one user requested
+
+        With previews, only jobs whose preview is still to come count.
+        Running jobs past JOB_TIMEOUT_SECONDS are orphans and do not.
+        """
+        query = cls.query.filter(db.or_(cls.state == cls.PENDING,
+                                        db.and_(cls.state == cls.RUNNING,
+                                                cls.started_at >=
+                                                cls._stale_before())))
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        if previews:
+            query = query.filter(cls.preview_first.is_(True))
+        return query.count()
+
+    @classmethod
+    def get_throughput(cls, window_seconds):
+        """Jobs finished per second over the last window_seconds"""
+        since = datetime.utcnow() - timedelta(seconds=window_seconds)
+        finished = cls.query.filter(cls.finished_at >= since).count()
+        return finished / float(window_seconds)
+
+    @classmethod
+    def claim_next(cls):
+        """Mark the next pending job as running and return it
+
+        Jobs waiting on a preview come first, then the longest queued. Jobs
+        whose worker died, those started over JOB_TIMEOUT_SECONDS ago, are
+        claimed again like pending ones. Rows locked by another worker are
+        skipped, so any number of workers can share the queue. Returns None
+        when the queue is empty.
+        """
+        style_job = cls.query.filter(db.or_(
+            cls.state == cls.PENDING,
+            db.and_(cls.state == cls.RUNNING,
+                    cls.started_at < cls._stale_before()))).order_by(
+            cls.preview_first.desc(), cls.queued_at,
+            cls.style_job_id).with_for_update(skip_locked=True).first()
+        if style_job is None:
+            db.session.commit()
+            return None
+
+        style_job.state = cls.RUNNING
+        style_job.started_at = datetime.utcnow()
+        db.session.commit()
+        return style_job
+
+    @staticmethod
+    def _stale_before():
+        return datetime.utcnow() - timedelta(seconds=JOB_TIMEOUT_SECONDS)
+
+    def run(self, testing=False):
+        """Apply the styles and record the outcome on the job"""
+        try:
+            if self.preview_first:
+                for style in self.styles:
+                    StyledImage.create_preview(self.source_image, style, self,
+                                               testing)
+                # pollers see the previews now; the full render waits its
+                # turn like any other job
+                self.preview_first = False
+                self.state = self.PENDING
+                self.queued_at = datetime.utcnow()
+                db.session.commit()
+                return self
+            previews = [styled_image for styled_image in self.styled_images
+                        if not styled_image.has_full]
+            if previews:
+                StyledImage.render_full(previews, testing)
+            else:
+                StyledImage.create_many(self.source_image, self.styles, self,
+                                        testing)
+            self.state = self.DONE
+        except Exception as e:
+            db.session.rollback()
+            self.state = self.FAILED
+            self.error = str(e)[:700]
+        self.finished_at = datetime.utcnow()
+        db.session.commit()
+        return self
+
+
+class StyleJobStyle(db.Model):
+    """StyleJobStyle association table model
+
+    Tablename:
+        style_job_styles
+
+    Required fields:
+        style_job_id  INT PRIMARY KEY REFERENCES style_jobs
+        style_id      INT PRIMARY KEY REFERENCES styles
+        position      INT
+    """
+
+    __tablename__ = 'style_job_styles'
+
+    style_job_id = db.Column(db.Integer,
+                             db.ForeignKey('style_jobs.style_job_id'),
+                             primary_key=True)
+    style_id = db.Column(db.Integer, db.ForeignKey('styles.style_id'),
+                         primary_key=True)
+    position = db.Column(db.Integer, default=0, nullable=False)
+    style_job = db.relationship('StyleJob')
+    style = db.relationship('Style')
+
+
 # ========================================================================== #
 # Likes & Comments
 
@@ -0,0 +1,162 @@
+"""Content-addressed cache of styled outputs for deep-paint
+
+Styling the same source bytes with the same style checkpoint at the same
+output size always produces the same image, so finished outputs are kept in
+a store keyed by those inputs. A hit hard-links the stored file to the new
+image's path instead of rerunning tensorflow. The store is bounded in size
+and evicts least recently used entries. An entry still linked from an image
+shares that image's bytes, so only entries nothing else links to count
+toward the bound or are evicted; removing the others would free nothing.
+"""
+
+from fast_style_transfer.metrics import Stats, register
+from hashlib import sha1
+from os import (environ, getcwd, link, listdir, makedirs, path, remove, stat,
+                utime)
+from shutil import copyfile
+from threading import Lock
+
+CACHE_PATH = getcwd() + '/static/cache/'
+MAX_CACHE_MB = int(environ.get('DEEP_PAINT_OUTPUT_CACHE_MB', 2048))
+
+
+def file_digest(file_path, chunk_size=2**16):
+    """SHA-1 of a file's bytes"""
+    digest = sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(source_digest, style_id, checkpoint_version, output_size):
+    """Cache key for one (source, style, checkpoint, size) combination"""
+    return sha1('{source}:{style}:{version}:{w}x{h}'.format(
+        source=source_digest, style=style_id, version=checkpoint_version,
+        w=output_size[0], h=output_size[1])).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        link(src, dst)
+    except OSError:
+        copyfile(src, dst)
+
+
+class OutputCache(object):
+    """Size-bounded, least recently used store of styled output files
+
+    Counters:
+        hits       outputs served from the store
+        misses     lookups that needed inference
+        stores     outputs added to the store
+        evictions  outputs removed to stay within max_bytes
+    """
+
+    def __init__(self, root=CACHE_PATH, max_mb=MAX_CACHE_MB):
+        self.root = root
+        self.max_bytes = max_mb * 2**20
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = Lock()
+        if not path.isdir(root):
+            makedirs(root)
+
+    def __repr__(self):
+        return '<OutputCache root="{root}" max_bytes={max}>'.format(
+            root=self.root, max=self.max_bytes)
+
+    def get_path(self, key, file_extension):
+        return '{root}{key}.{ext}'.format(root=self.root, key=key,
+                                          ext=file_extension)
+
+    def fetch(self, key, out_path):
+        """Link a cached output to out_path, return False on a miss"""
+        cached_path = self.get_path(key, out_path.rsplit('.', 1)[1])
+        try:
+            _link_or_copy(cached_path, out_path)
+            utime(cached_path, None)  # mark as recently used
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return False
+
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, out_path):
+        """Add a freshly styled output to the cache"""
+        cached_path = self.get_path(key, out_path.rsplit('.', 1)[1])
+        try:
+            if path.isfile(cached_path):
+                remove(cached_path)
+            _link_or_copy(out_path, cached_path)
+        except (IOError, OSError):
+            return
+        with self._lock:
+            self.stores += 1
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used outputs until under max_bytes
+
+        Only outputs the cache alone holds a link to count.
+        """
+        with self._lock:
+            entries = []
+            for filename in listdir(self.root):
+                file_path = self.root + filename
+                try:
+                    file_stat = stat(file_path)
+                except OSError:
+                    continue
+                if file_stat.st_nlink == 1:
+                    entries.append((file_stat.st_mtime, file_stat.st_size,
+                                    file_path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, file_path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    remove(file_path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'hitRate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+_output_cache = None
+_output_cache_lock = Lock()
+
+
+def _output_cache_stats():
+    return _output_cache.stats() if _output_cache is not None else None
+
+
+register(Stats('deep_paint_output_cache', 'Styled output cache',
+               _output_cache_stats,
+               counters=('hits', 'misses', 'stores', 'evictions')))
+
+
+def get_output_cache():
+    """Return the process-wide OutputCache"""
+    global _output_cache
+    with _output_cache_lock:
+        if _output_cache is None:
+            _output_cache = OutputCache()
+        return _output_cache
@@ -1,12 +1,15 @@
 """Flask app for deeppaint"""
 
+from admission import Saturated, check_job_queue
+from fast_style_transfer import metrics
 from flask import (Flask, render_template, redirect, request, session, flash,
-                   jsonify)
-from model import (User, Image, SourceImage, StyledImage, Style, Like, db,
+                   jsonify, g, Response)
+from model import (User, Image, SourceImage, Style, StyleJob, Like, db,
                    connect_to_db)
 from flask_debugtoolbar import DebugToolbarExtension
 # from pprint import pprint
 import os
+import time
 
 
 
@@ -185,8 +188,15 @@ def process_style():
         image_id=int(source_image_id)).one_or_none()
     style = Style.query.get(int(style_id))
 
-    StyledImage.create(source_image, style)
-    flash('Style applied successfully', 'info')
+    user = get_session_user()
+    try:
+        check_job_queue(user and user.user_id)
+    except Saturated as e:
+        flash('{message}, try again in {secs} seconds'.format(
+            message=str(e).capitalize(), secs=e.retry_after), 'warning')
+        return redirect('/style')
+    StyleJob.create(source_image, [style], user=user)
+    flash('Style queued, your image will appear shortly', 'info')
 
     # print '-----> /style -> ', styled_image
     return redirect('/')
@@ -281,34 +291,134 @@ def process_style_ajax_form():
     if style is None:
         return jsonify({'message': 'style not found'})
 
-    sty_img = StyledImage.create(source_image, style)
+    user = get_session_user()
+    preview = bool(ajax.get('preview'))
+    check_job_queue(user and user.user_id, preview)
+    # a preview is rendered by the worker ahead of other jobs; the client
+    # polls the job for it and then for the full resolution render
+    style_job = StyleJob.create(source_image, [style], user=user,
+                                preview_first=preview)
     result = {
-        'image': {
-            'createdAt': sty_img.image.created_at.strftime('%b %d, %Y'),
-            'imageId': sty_img.image_id,
-            'path': sty_img.get_path(),
-            'styledImage': {
-                'artist': sty_img.style.artist,
-                'path': sty_img.style.image.get_path(),
-                'sourceImage': {
-                    'imageId': sty_img.source_image.image_id,
-                    'title': sty_img.source_image.title,
-                },
-                'title': sty_img.style.title,
-            },
-            'user': {
-                'userId': sty_img.image.user.user_id,
-                'username': sty_img.image.user.username,
-                'createdAt': sty_img.image.user.created_at.strftime(
-                    '%b %d, %Y')
-            },
-        },
+        'job': get_style_job_result(style_job),
+    }
+
+    # pprint(result)
+    return jsonify(result)
+
+
+@app.route('/ajax/style-many.json', methods=['POST'])
+def process_style_many_ajax_form():
+    """Style an image with several styles in one job"""
+
+    ajax = request.get_json()
+
+    image_id = ajax.get('imageId')
+    if image_id is None:
+        return jsonify({'message': 'no image part'})
+    style_ids = ajax.get('styleIds')
+    if not style_ids:
+        return jsonify({'message': 'no style part'})
+
+    source_image = SourceImage.query.filter_by(
+        image_id=int(image_id)).one_or_none()
+    if source_image is None:
+        return jsonify({'message': 'image not found'})
+
+    style_ids = [int(style_id) for style_id in style_ids]
+    styles = {style.style_id: style for style in
+              Style.query.filter(Style.style_id.in_(style_ids)).all()}
+    if len(styles) != len(set(style_ids)):
+        return jsonify({'message': 'style not found'})
+    styles = [styles.pop(style_id) for style_id in style_ids
+              if style_id in styles]
+
+    user = get_session_user()
+    check_job_queue(user and user.user_id)
+    style_job = StyleJob.create(source_image, styles, user=user)
+    result = {
+        'job': get_style_job_result(style_job),
     }
 
     # pprint(result)
     return jsonify(result)
 
 
+@app.route('/ajax/style-job-status.json', methods=['POST'])
+def get_style_job_status_ajax():
+    """Poll the state of a queued style job"""
+
+    ajax = request.get_json()
+
+    job_id = ajax.get('jobId')
+    if job_id is None:
+        return jsonify({'message': 'no job part'})
+    style_job = StyleJob.query.get(int(job_id))
+    if style_job is None:
+        return jsonify({'message': 'job not found'})
+
+    result = {
+        'job': get_style_job_result(style_job),
+    }
+    if style_job.styled_images:
+        result['images'] = [get_styled_image_result(sty_img)
+                            for sty_img in style_job.styled_images]
+        result['image'] = result['images'][0]
+
+    # pprint(result)
+    return jsonify(result)
+
+
+def get_session_user():
+    """The logged in user, whose share of the queue a styling request uses
+
+    Jobs count against whoever asked for them, not the owner of the source
+    image, so styling other people's public images cannot exhaust their
+    share. Anonymous requests only count against the global limits.
+    """
+
+    user_id = session.get('userId')
+    if user_id is None:
+        return None
+    return User.query.get(int(user_id))
+
+
+def get_style_job_result(style_job):
+    """Serialize a style job for ajax responses"""
+
+    return {
+        'jobId': style_job.style_job_id,
+        'state': style_job.state,
+        'error': style_job.error,
+        'styleIds': [style.style_id for style in style_job.styles],
+    }
+
+
+def get_styled_image_result(sty_img):
+    """Serialize a finished styled image for ajax responses"""
+
+    return {
+        'createdAt': sty_img.image.created_at.strftime('%b %d, %Y'),
+        'imageId': sty_img.image_id,
+        'path': sty_img.get_path(),
+        'tiers': sty_img.get_tiers(),
+        'styledImage': {
+            'artist': sty_img.style.artist,
+            'path': sty_img.style.image.get_path(),
+            'sourceImage': {
+                'imageId': sty_img.source_image.image_id,
+                'title': sty_img.source_image.title,
+            },
+            'title': sty_img.style.title,
+        },
+        'user': {
+            'userId': sty_img.image.user.user_id,
+            'username': sty_img.image.user.username,
+            'createdAt': sty_img.image.user.created_at.strftime(
+                '%b %d, %Y')
+        },
+    }
+
+
 # Image interactions
 # -------------------------------------------------------------------------- #
 
@@ -355,7 +465,7 @@ def get_images_ajax():
             'imageId': image.image_id,
             'isLiked': False,
             'likeCount': len(image.likes),
-            'path': image.get_path(),
+            'path': image.get_best_path(),
             'user': {
                 'userId': image.user.user_id,
                 'username': image.user.username,
@@ -403,7 +513,7 @@ def get_image_details_ajax():
         'image': {
             'createdAt': image.created_at.strftime("%b %d, %Y"),
             'imageId': image.image_id,
-            'path': image.get_path(),
+            'path': image.get_best_path(),
             'user': {
                 'userId': image.user.user_id,
                 'username': image.user.username,
@@ -490,7 +600,7 @@ def edit_image():
     result['image'] = {
         'createdAt': image.created_at.strftime('%b %d, %Y'),
         'imageId': image.image_id,
-        'path': image.get_path(),
+        'path': image.get_best_path(),
         'user': {
             'userId': image.user.user_id,
             'username': image.user.username,
@@ -593,6 +703,49 @@ def toggle_like_state_ajax():
     return jsonify(result)
 
 
+# ========================================================================== #
+# Admission control
+# ========================================================================== #
+
+
+@app.errorhandler(Saturated)
+def handle_saturated(error):
+    """Turn away styling requests the server cannot take right now"""
+
+    response = jsonify({'message': str(error),
+                        'retryAfter': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+# ========================================================================== #
+# Metrics
+# ========================================================================== #
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.time()
+
+
+@app.after_request
+def record_request_latency(response):
+    start_time = getattr(g, 'request_start_time', None)
+    if start_time is not None:
+        metrics.REQUEST_SECONDS.observe(
+            time.time() - start_time, endpoint=request.endpoint or 'unknown',
+            method=request.method, status=response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Latency histograms in Prometheus text format"""
+
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 # ========================================================================== #
 # Main
 # ========================================================================== #
@@ -979,14 +979,20 @@ class SignupForm extends React.Component {
 // Style
 // ------------------------------------------------------------------------- //
 
+const JOB_POLL_INTERVAL = 1000;
+
 class StyleForm extends React.Component {
   submitForm = (e) => {
     e.preventDefault();
     this.props.setLoading(true);
+    this.requestStyle();
+  }
+  requestStyle = () => {
     fetch("/ajax/style.json", {
       method: "POST",
       body: JSON.stringify({
         imageId: this.props.styleTarget.imageId,
+        preview: true,
         styleId: this.props.selectedStyle
       }),
       credentials: "same-origin",
@@ -996,6 +1002,42 @@ class StyleForm extends React.Component {
     })
     .then(r => r.json())
     .then(r => {
+      if (r.retryAfter) {
+        // styling is saturated, try again once the server expects room
+        setTimeout(this.requestStyle, r.retryAfter * 1000);
+        return;
+      }
+      if (r.job) {
+        this.pollJob(r.job.jobId);
+      } else {
+        this.props.setView("library");
+        console.log(r);
+      }
+    });
+  }
+  pollJob = (jobId, showingPreview = false) => {
+    fetch("/ajax/style-job-status.json", {
+      method: "POST",
+      body: JSON.stringify({
+        jobId: jobId
+      }),
+      credentials: "same-origin",
+      headers: new Headers({
+        "content-type": "application/json"
+      })
+    })
+    .then(r => r.json())
+    .then(r => {
+      if (r.job && (r.job.state === "pending" || r.job.state === "running")) {
+        if (r.image && !showingPreview) {
+          // show the preview while the full resolution render finishes
+          this.props.setView("library");
+          this.props.setFocusImage(r.image);
+        }
+        setTimeout(() => this.pollJob(jobId, showingPreview || !!r.image),
+                   JOB_POLL_INTERVAL);
+        return;
+      }
       this.props.setView("library");
       if (r.image) {
         this.props.setFocusImage(r.image);
@@ -1,10 +1,37 @@
 """Tests for deep-paint project"""
 
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from flask import Flask
+from io import BytesIO
+import numpy as np
+import tensorflow as tf
+from admission import Saturated, check_job_queue
+from fast_style_transfer import (freeze, metrics, optimize, pool, shards,
+                                 tiling, transform, vgg)
+from fast_style_transfer.engine import (InferenceEngine, StyleSession,
+                                        get_engine, within_budget)
+from fast_style_transfer.scheduler import BatchScheduler
+from fast_style_transfer.evaluate import (ffwd, ffwd_different_dimensions,
+                                          ffwd_tiled)
+from fast_style_transfer.utils import get_img, save_img
 from model import (User, Image, SourceImage, StyledImage, TFModel, Style,
-                   Comment, Like, Tag, ImageTag, db, connect_to_db)
+                   StyleJob, Comment, Like, Tag, ImageTag, BASEPATH,
+                   JOB_TIMEOUT_SECONDS, MAX_IMAGE_EDGE, db, connect_to_db)
+from mock import patch
+from output_cache import OutputCache
+from PIL import Image as PILImage
+from scipy.io import savemat
 from seed import seed_data, FileStorage
+from shutil import rmtree
+from tempfile import mkdtemp
 
 # for drop_everything() helper function
 from sqlalchemy.engine import reflection
@@ -149,6 +176,30 @@ class ModelImageTests(AbstractModelTests):
         self.assertEqual(image.is_public, user.pref_is_public)
         print '+ passed'
 
+    def test_image_creation_saves_by_extension(self):
+        print '- test_image_creation_saves_by_extension'
+        # the upload's own format is not always one pillow can write
+        upload = BytesIO()
+        PILImage.new('RGB', (MAX_IMAGE_EDGE * 2, 8)).save(upload, 'PNG')
+        upload.seek(0)
+        image = Image.create(FileStorage(stream=upload, filename='wide.jpg'))
+        saved = PILImage.open(BASEPATH + image.get_path())
+        self.assertEqual(saved.format, 'JPEG')
+        self.assertEqual(saved.size, (MAX_IMAGE_EDGE, 4))
+        print '+ passed'
+
+    def test_image_get_array(self):
+        print '- test_image_get_array'
+        image_file = FileStorage(stream=open(
+            'fast_style_transfer/source-images/cape-flattery.jpg'))
+        image = Image.create(image_file)
+        img = image.get_array()
+        self.assertEqual(img.shape[2], 3)
+        self.assertLessEqual(max(img.shape[:2]), MAX_IMAGE_EDGE)
+        # kept from the upload rather than read back from disk
+        self.assertIs(image.get_array(), img)
+        print '+ passed'
+
     def test_image_get_filename(self):
         print '- test_image_get_filename'
         filename = '1.jpg'
@@ -245,6 +296,42 @@ class ModelStyledImageTests(AbstractModelTests):
         self.assertIsInstance(styled_image.source_image, SourceImage)
         print '+ passed'
 
+    def test_styled_image_create_many(self):
+        print '- test_styled_image_create_many'
+        source_image = SourceImage.query.get(1)
+        styles = [Style.query.get(1), Style.query.get(2)]
+        styled_images = StyledImage.create_many(source_image, styles,
+                                                testing=True)
+        self.assertEqual(len(styled_images), 2)
+        self.assertEqual([s.styled_image_id for s in styled_images], [2, 3])
+        self.assertEqual([s.style_id for s in styled_images], [1, 2])
+        self.assertEqual([s.image_id for s in styled_images], [9, 10])
+        for styled_image in styled_images:
+            self.assertEqual(styled_image.source_image_id, 1)
+            self.assertIsNone(styled_image.style_job)
+        print '+ passed'
+
+    def test_styled_image_create_preview(self):
+        print '- test_styled_image_create_preview'
+        source_image = SourceImage.query.get(1)
+        style = Style.query.get(1)
+        styled_image = StyledImage.create_preview(source_image, style,
+                                                  testing=True)
+        self.assertTrue(styled_image.has_preview)
+        self.assertFalse(styled_image.has_full)
+        self.assertEqual(styled_image.get_tiers(), ['preview'])
+        self.assertEqual(styled_image.get_path(),
+                         styled_image.image.get_path('preview_'))
+
+        style_job = StyleJob.create(source_image, [style], [styled_image])
+        style_job.run(testing=True)
+        self.assertEqual(style_job.state, StyleJob.DONE)
+        self.assertEqual(style_job.styled_images, [styled_image])
+        self.assertEqual(styled_image.get_tiers(), ['preview', 'full'])
+        self.assertEqual(styled_image.get_path(),
+                         styled_image.image.get_path())
+        print '+ passed'
+
     def test_styled_image_get_path(self):
         print '- test_styled_image_get_path'
         self.assertEqual(self.styled_image.get_path(), 'static/image/8.jpg')
@@ -312,6 +399,31 @@ class ModelStyleTests(AbstractModelTests):
         self.assertIsInstance(style.image, Image)
         print '+ passed'
 
+    def test_style_get_most_used(self):
+        print '- test_style_get_most_used'
+        styles = Style.get_most_used()
+        self.assertEqual(len(styles), 6)
+        self.assertEqual(styles[0].style_id, 1)
+        source_image = SourceImage.query.get(1)
+        for _ in range(2):
+            StyledImage.create(source_image, Style.query.get(3), testing=True)
+        self.assertEqual(Style.get_most_used()[0].style_id, 3)
+        print '+ passed'
+
+    def test_style_variants(self):
+        print '- test_style_variants'
+        self.assertEqual(self.style.get_variants(), [Style.FULL])
+        self.assertEqual(self.style.choose_variant(latency_bound=True),
+                         Style.FULL)
+        self.style.has_lite = True
+        self.assertEqual(self.style.get_variants(), [Style.FULL, Style.LITE])
+        self.assertEqual(self.style.choose_variant(), Style.FULL)
+        self.assertEqual(self.style.choose_variant(latency_bound=True),
+                         Style.LITE)
+        self.assertEqual(self.style.get_path(Style.LITE),
+                         '/static/style/1.lite.ckpt')
+        print '+ passed'
+
     def test_style_repr(self):
         print '- test_style_repr'
         self.assertEqual(repr(self.style),
@@ -319,6 +431,131 @@ class ModelStyleTests(AbstractModelTests):
         print '+ passed'
 
 
+# ========================================================================== #
+# StyleJob Tests
+
+class ModelStyleJobTests(AbstractModelTests):
+
+    def setUp(self):
+        super(ModelStyleJobTests, self).setUp()
+        self.style_job = StyleJob.create(SourceImage.query.get(1),
+                                         [Style.query.get(2)],
+                                         user=User.query.get(1))
+
+    def test_style_job_creation(self):
+        print '- test_style_job_creation'
+        self.assertEqual(self.style_job.style_job_id, 1)
+        self.assertIsInstance(self.style_job, StyleJob)
+        self.assertEqual(self.style_job.state, StyleJob.PENDING)
+        self.assertEqual(self.style_job.source_image_id, 1)
+        self.assertEqual(self.style_job.user_id, 1)
+        self.assertEqual([style.style_id for style in self.style_job.styles],
+                         [2])
+        self.assertEqual(self.style_job.styled_images, [])
+        print '+ passed'
+
+    def test_style_job_claim_next(self):
+        print '- test_style_job_claim_next'
+        style_job = StyleJob.claim_next()
+        self.assertEqual(style_job.style_job_id, 1)
+        self.assertEqual(style_job.state, StyleJob.RUNNING)
+        self.assertIsNotNone(style_job.started_at)
+        self.assertIsNone(StyleJob.claim_next())
+        print '+ passed'
+
+    def test_style_job_run(self):
+        print '- test_style_job_run'
+        style_job = StyleJob.claim_next().run(testing=True)
+        self.assertEqual(style_job.state, StyleJob.DONE)
+        self.assertEqual(len(style_job.styled_images), 1)
+        self.assertIsInstance(style_job.styled_images[0], StyledImage)
+        self.assertEqual(style_job.styled_images[0].style_id, 2)
+        self.assertIsNotNone(style_job.finished_at)
+        print '+ passed'
+
+    def test_style_job_many_styles(self):
+        print '- test_style_job_many_styles'
+        styles = [Style.query.get(3), Style.query.get(1), Style.query.get(5)]
+        style_job = StyleJob.create(SourceImage.query.get(1), styles)
+        self.assertEqual([style.style_id for style in style_job.styles],
+                         [3, 1, 5])
+        print '+ passed'
+
+    def test_style_job_count_active(self):
+        print '- test_style_job_count_active'
+        self.assertEqual(StyleJob.count_active(), 1)
+        self.assertEqual(StyleJob.count_active(1), 1)
+        self.assertEqual(StyleJob.count_active(2), 0)
+        StyleJob.claim_next().run(testing=True)
+        self.assertEqual(StyleJob.count_active(), 0)
+        self.assertGreater(StyleJob.get_throughput(60), 0)
+        print '+ passed'
+
+    def test_style_job_reclaim_orphan(self):
+        print '- test_style_job_reclaim_orphan'
+        style_job = StyleJob.claim_next()
+        self.assertIsNone(StyleJob.claim_next())
+        # its worker died long ago
+        style_job.started_at = datetime.utcnow() - timedelta(
+            seconds=JOB_TIMEOUT_SECONDS + 1)
+        db.session.commit()
+        self.assertEqual(StyleJob.count_active(), 0)
+        self.assertEqual(StyleJob.count_active(1), 0)
+        self.assertEqual(StyleJob.claim_next(), style_job)
+        self.assertEqual(style_job.state, StyleJob.RUNNING)
+        self.assertEqual(StyleJob.count_active(), 1)
+        self.assertIsNone(StyleJob.claim_next())
+        print '+ passed'
+
+    def test_style_job_count_active_by_requester(self):
+        print '- test_style_job_count_active_by_requester'
+        other = User.create('test2', 'test2@email.com', 'password')
+        # styling someone else's image counts against the requester
+        StyleJob.create(SourceImage.query.get(1), [Style.query.get(1)],
+                        user=other)
+        self.assertEqual(StyleJob.count_active(1), 1)
+        self.assertEqual(StyleJob.count_active(other.user_id), 1)
+        StyleJob.create(SourceImage.query.get(1), [Style.query.get(1)])
+        self.assertEqual(StyleJob.count_active(), 3)
+        self.assertEqual(StyleJob.count_active(1), 1)
+        print '+ passed'
+
+    def test_style_job_preview_first(self):
+        print '- test_style_job_preview_first'
+        style_job = StyleJob.create(SourceImage.query.get(1),
+                                    [Style.query.get(1)],
+                                    user=User.query.get(1),
+                                    preview_first=True)
+        self.assertEqual(StyleJob.count_active(1, previews=True), 1)
+        with self.assertRaises(Saturated):
+            check_job_queue(1, preview=True)
+
+        # previews go ahead of older jobs, then queue behind every job
+        # waiting by then, including ones created after them
+        self.assertEqual(StyleJob.claim_next(), style_job)
+        later = StyleJob.create(SourceImage.query.get(1), [Style.query.get(3)])
+        style_job.run(testing=True)
+        self.assertEqual(style_job.state, StyleJob.PENDING)
+        self.assertFalse(style_job.preview_first)
+        self.assertEqual([s.get_tiers() for s in style_job.styled_images],
+                         [['preview']])
+        self.assertIsNone(style_job.finished_at)
+        self.assertEqual(StyleJob.claim_next(), self.style_job)
+        self.assertEqual(StyleJob.claim_next(), later)
+        self.assertEqual(StyleJob.claim_next(), style_job)
+        style_job.run(testing=True)
+        self.assertEqual(style_job.state, StyleJob.DONE)
+        self.assertEqual([s.get_tiers() for s in style_job.styled_images],
+                         [['preview', 'full']])
+        print '+ passed'
+
+    def test_style_job_repr(self):
+        print '- test_style_job_repr'
+        self.assertEqual(repr(self.style_job),
+                         '<StyleJob style_job_id=1 state="pending">')
+        print '+ passed'
+
+
 # ========================================================================== #
 # Comment Tests
 
@@ -430,6 +667,758 @@ class ModelImageTagTests(AbstractModelTests):
         print '+ passed'
 
 
+# ========================================================================== #
+# ========================================================================== #
+# Output Cache Tests
+
+class OutputCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp() + '/'
+        self.cache = OutputCache(self.tmp_dir + 'cache/', max_mb=1)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def write_output(self, filename, size=1024):
+        with open(self.tmp_dir + filename, 'wb') as f:
+            f.write('x' * size)
+        return self.tmp_dir + filename
+
+    def test_output_cache_miss_then_hit(self):
+        print '- test_output_cache_miss_then_hit'
+        self.assertFalse(self.cache.fetch('key', self.tmp_dir + '1.jpg'))
+        self.cache.store('key', self.write_output('1.jpg'))
+        self.assertTrue(self.cache.fetch('key', self.tmp_dir + '2.jpg'))
+        with open(self.tmp_dir + '2.jpg', 'rb') as f:
+            self.assertEqual(f.read(), 'x' * 1024)
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hitRate'], 0.5)
+        print '+ passed'
+
+    def test_output_cache_eviction(self):
+        print '- test_output_cache_eviction'
+        for i in range(3):
+            self.cache.store('key{}'.format(i),
+                             self.write_output('{}.jpg'.format(i), 2**19))
+        # every entry is still linked from its output, so none count
+        self.assertEqual(self.cache.stats()['evictions'], 0)
+        for i in range(3):
+            os.remove(self.tmp_dir + '{}.jpg'.format(i))
+        self.cache.evict()
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertFalse(self.cache.fetch('key0', self.tmp_dir + 'a.jpg'))
+        self.assertTrue(self.cache.fetch('key2', self.tmp_dir + 'b.jpg'))
+        print '+ passed'
+
+
+# ========================================================================== #
+# ========================================================================== #
+# Inference Engine Tests
+
+class FakeStyleSession(object):
+    """Stands in for a restored StyleSession, failing if closed mid-run"""
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        self.is_closed = False
+
+    def run(self, X):
+        time.sleep(0.01)
+        if self.is_closed:
+            raise RuntimeError('session closed during run')
+        return X
+
+    def close(self):
+        self.is_closed = True
+
+
+class FakeInferenceEngine(InferenceEngine):
+
+    def __init__(self, *args, **kwargs):
+        super(FakeInferenceEngine, self).__init__(*args, **kwargs)
+        self.sessions = []
+
+    def _create_session(self, checkpoint_dir, device_t):
+        self.sessions.append(FakeStyleSession(checkpoint_dir))
+        return self.sessions[-1]
+
+
+class InferenceEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeInferenceEngine(max_styles=3)
+        self.X = np.zeros((1, 4, 4, 3), dtype=np.float32)
+
+    def test_engine_lease_outlives_eviction(self):
+        print '- test_engine_lease_outlives_eviction'
+        lease = self.engine.get('style0')
+        self.engine.evict()
+        self.assertFalse(lease.style_session.is_closed)
+        self.assertEqual(self.engine.stats()['retired'], 1)
+        lease.run(self.X)
+        lease.release()
+        self.assertTrue(lease.style_session.is_closed)
+        self.assertEqual(self.engine.stats()['retired'], 0)
+        print '+ passed'
+
+    def test_engine_concurrent_styles(self):
+        print '- test_engine_concurrent_styles'
+        executor = ThreadPoolExecutor(12)
+        try:
+            # twice as many styles as max_styles, so runs race evictions
+            list(executor.map(
+                lambda i: self.engine.run('style{}'.format(i % 6), self.X),
+                range(120)))
+        finally:
+            executor.shutdown()
+        stats = self.engine.stats()
+        self.assertLessEqual(stats['resident'], 3)
+        self.assertEqual(stats['retired'], 0)
+        self.assertGreater(stats['evictions'], 0)
+        self.assertEqual(len([style_session
+                              for style_session in self.engine.sessions
+                              if style_session.is_closed]),
+                         stats['evictions'])
+        print '+ passed'
+
+
+    def test_engine_warm_up(self):
+        print '- test_engine_warm_up'
+        tmp_dir = mkdtemp() + '/'
+        try:
+            # in order of importance, 1MB each
+            checkpoint_dirs = [tmp_dir + 'style{}.ckpt'.format(i)
+                               for i in range(5)]
+            for checkpoint_dir in checkpoint_dirs:
+                with open(checkpoint_dir, 'wb') as f:
+                    f.write('x' * 2**20)
+            # styles past the memory budget are skipped
+            checkpoint_dirs = within_budget(checkpoint_dirs, 4.5)
+            self.assertEqual(len(checkpoint_dirs), 4)
+            # and past max_styles
+            warmed = self.engine.warm_up(checkpoint_dirs, [4, 8])
+        finally:
+            rmtree(tmp_dir)
+        self.assertEqual(warmed, checkpoint_dirs[:3])
+        self.assertEqual([style_session.checkpoint_dir
+                          for style_session in self.engine.sessions],
+                         warmed[::-1])
+        # the most important style is the most recently used
+        self.assertEqual([key[0] for key in self.engine._styles],
+                         warmed[::-1])
+        stats = self.engine.stats()
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['evictions'], 0)
+        print '+ passed'
+
+
+class FakeEngine(object):
+    """Records the batches a scheduler runs, optionally failing them
+
+    Each run takes delay seconds; max_running is the most that overlapped.
+    """
+
+    def __init__(self, error=None, delay=0):
+        self.error = error
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def run(self, checkpoint_dir, X, device_t):
+        with self._lock:
+            self.calls.append((checkpoint_dir, device_t, X.shape))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self._lock:
+            self.running -= 1
+        if self.error is not None:
+            raise self.error
+        return X + 1
+
+
+class BatchSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeEngine()
+        self.img = np.zeros((4, 4, 3), dtype=np.float32)
+
+    def scheduler(self, max_wait_ms=60000, max_batch=4):
+        return BatchScheduler(self.engine, max_wait_ms, max_batch)
+
+    def test_scheduler_groups_by_key(self):
+        print '- test_scheduler_groups_by_key'
+        scheduler = self.scheduler()
+        futures = [scheduler.submit('a', self.img),
+                   scheduler.submit('a', self.img),
+                   scheduler.submit('b', self.img),
+                   scheduler.submit('a', self.img, '/device:GPU:0'),
+                   scheduler.submit('a', np.zeros((8, 4, 3)))]
+        scheduler.close()
+        self.assertEqual(sorted(self.engine.calls), [
+            ('a', '/device:CPU:0', (1, 8, 4, 3)),
+            ('a', '/device:CPU:0', (2, 4, 4, 3)),
+            ('a', '/device:GPU:0', (1, 4, 4, 3)),
+            ('b', '/device:CPU:0', (1, 4, 4, 3))])
+        for future in futures:
+            self.assertEqual(future.result().max(), 1)
+        self.assertEqual(scheduler.stats()['batches'], 4)
+        print '+ passed'
+
+    def test_scheduler_splits_at_max_batch(self):
+        print '- test_scheduler_splits_at_max_batch'
+        scheduler = self.scheduler(max_batch=2)
+        futures = [scheduler.submit('a', self.img) for _ in range(5)]
+        # full batches go without waiting out max_wait_ms
+        futures[3].result(timeout=5)
+        scheduler.close()
+        self.assertEqual([shape[0] for _, _, shape in self.engine.calls],
+                         [2, 2, 1])
+        print '+ passed'
+
+    def test_scheduler_flushes_at_deadline(self):
+        print '- test_scheduler_flushes_at_deadline'
+        scheduler = self.scheduler(max_wait_ms=50)
+        start_time = time.time()
+        result = scheduler.submit('a', self.img).result(timeout=5)
+        self.assertGreaterEqual(time.time() - start_time, 0.04)
+        self.assertEqual(result.shape, self.img.shape)
+        self.assertEqual(len(self.engine.calls), 1)
+        scheduler.close()
+        print '+ passed'
+
+    def test_scheduler_memory_budget(self):
+        print '- test_scheduler_memory_budget'
+        # two 4x4 images fit in 32KB at tiling.BYTES_PER_PIXEL
+        scheduler = BatchScheduler(self.engine, 60000, 4,
+                                   max_memory_mb=32 / 1024.0)
+        for _ in range(5):
+            scheduler.submit('a', self.img)
+        scheduler.close()
+        self.assertEqual([shape[0] for _, _, shape in self.engine.calls],
+                         [2, 2, 1])
+        print '+ passed'
+
+    def test_scheduler_keys_run_concurrently(self):
+        print '- test_scheduler_keys_run_concurrently'
+        self.engine.delay = 0.2
+        scheduler = self.scheduler(max_wait_ms=0, max_batch=1)
+        futures = [scheduler.submit('a', self.img),
+                   scheduler.submit('b', self.img)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(self.engine.max_running, 2)
+        # one batch at a time per key
+        self.engine.max_running = 0
+        futures = [scheduler.submit('a', self.img) for _ in range(2)]
+        scheduler.close()
+        self.assertEqual(self.engine.max_running, 1)
+        self.assertTrue(all(future.done() for future in futures))
+        print '+ passed'
+
+    def test_scheduler_error_reaches_every_future(self):
+        print '- test_scheduler_error_reaches_every_future'
+        self.engine.error = ValueError('bad batch')
+        scheduler = self.scheduler()
+        futures = [scheduler.submit('a', self.img) for _ in range(3)]
+        scheduler.close()
+        self.assertEqual(len(self.engine.calls), 1)
+        for future in futures:
+            self.assertRaises(ValueError, future.result, 0)
+        print '+ passed'
+
+    def test_scheduler_close_flushes(self):
+        print '- test_scheduler_close_flushes'
+        scheduler = self.scheduler()
+        futures = [scheduler.submit('a', self.img) for _ in range(2)]
+        self.assertFalse(any(future.done() for future in futures))
+        scheduler.close()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertRaises(AssertionError, scheduler.submit, 'a', self.img)
+        print '+ passed'
+
+
+class PoolTests(unittest.TestCase):
+
+    def test_split_cores_uneven(self):
+        print '- test_split_cores_uneven'
+        self.assertEqual(pool.split_cores(range(5), 2),
+                         [set([0, 1]), set([2, 3, 4])])
+        self.assertEqual(pool.split_cores(range(4), 4),
+                         [set([0]), set([1]), set([2]), set([3])])
+        # more processes than cores share them
+        self.assertEqual(pool.split_cores(range(2), 3),
+                         [set([0]), set([1]), set([0])])
+        print '+ passed'
+
+    def test_split_cores_affinity_mask(self):
+        print '- test_split_cores_affinity_mask'
+        # only the cores the process may use, wherever they start
+        self.assertEqual(pool.split_cores([9, 4, 6, 5, 8, 7], 3),
+                         [set([4, 5]), set([6, 7]), set([8, 9])])
+        print '+ passed'
+
+    def test_pick_core_set_wraps(self):
+        print '- test_pick_core_set_wraps'
+        core_sets = pool.split_cores([4, 5, 6, 7], 2)
+        self.assertEqual(pool.pick_core_set(core_sets, 0), set([4, 5]))
+        self.assertEqual(pool.pick_core_set(core_sets, 1), set([6, 7]))
+        # replacements for dead processes get later indexes
+        self.assertEqual(pool.pick_core_set(core_sets, 2), set([4, 5]))
+        self.assertEqual(pool.pick_core_set(core_sets, 5), set([6, 7]))
+        print '+ passed'
+
+
+# ========================================================================== #
+# ========================================================================== #
+# Import Tests
+
+class LazyImportTests(unittest.TestCase):
+
+    def test_model_import_skips_tensorflow(self):
+        print '- test_model_import_skips_tensorflow'
+        loaded = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, model; print "tensorflow" in sys.modules'])
+        self.assertEqual(loaded.strip(), 'False')
+        print '+ passed'
+
+
+# ========================================================================== #
+# ========================================================================== #
+# Metrics Tests
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram_render(self):
+        print '- test_histogram_render'
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('stage',),
+                                      buckets=(.1, 1))
+        histogram.observe(.05, stage='decode')
+        histogram.observe(.5, stage='decode')
+        lines = histogram.render()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{stage="decode",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="decode",le="+Inf"} 2',
+                      lines)
+        self.assertIn('test_seconds_count{stage="decode"} 2', lines)
+        print '+ passed'
+
+    def test_stats_render(self):
+        print '- test_stats_render'
+        stats = {'hits': 3, 'hitRate': .5, 'device': '/device:CPU:0'}
+        lines = metrics.Stats('test', 'Test.', lambda: stats,
+                              counters=('hits',)).render()
+        self.assertIn('# TYPE test_hits_total counter', lines)
+        self.assertIn('test_hits_total 3.0', lines)
+        self.assertIn('# TYPE test_hit_rate gauge', lines)
+        self.assertIn('test_hit_rate 0.5', lines)
+        self.assertEqual(len(lines), 6)
+        # nothing while the component does not exist
+        self.assertEqual(metrics.Stats('test', 'Test.', lambda: None,
+                                       counters=('hits',)).render(), [])
+        print '+ passed'
+
+    def test_stage_labels(self):
+        print '- test_stage_labels'
+        self.assertEqual(metrics.style_label('static/style/3.ckpt'), '3')
+        self.assertEqual(metrics.resolution_bucket((1, 300, 400, 3)), '512')
+        self.assertEqual(metrics.resolution_bucket((4000, 10)), '+Inf')
+        print '+ passed'
+
+
+# ========================================================================== #
+# ========================================================================== #
+# Inference Tests
+
+def save_random_checkpoint(checkpoint_path, **config):
+    """Save an untrained transform.net, enough to compare outputs"""
+    with tf.Graph().as_default(), tf.Session() as sess:
+        transform.net(tf.placeholder(tf.float32, (None, None, None, 3)),
+                      **config)
+        sess.run(tf.global_variables_initializer())
+        tf.train.Saver().save(sess, checkpoint_path)
+    return checkpoint_path
+
+
+class FfwdBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp() + '/'
+        self.checkpoint_dir = save_random_checkpoint(
+            self.tmp_dir + 'random.ckpt')
+        self.images = np.random.uniform(0, 255, (5, 32, 48, 3))
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def style(self, images, prefix, batch_size):
+        paths_out = [self.tmp_dir + '{}_{}.png'.format(prefix, i)
+                     for i in range(len(images))]
+        ffwd(images, paths_out, self.checkpoint_dir,
+             device_t='/device:CPU:0', batch_size=batch_size)
+        return [get_img(path_out).astype(np.int16) for path_out in paths_out]
+
+    def test_ffwd_partial_batches(self):
+        print '- test_ffwd_partial_batches'
+        expected = self.style(self.images, 'single', 1)
+        for n in range(1, len(self.images) + 1):
+            outputs = self.style(self.images[:n], 'batch{}'.format(n), 3)
+            self.assertEqual(len(outputs), n)
+            for output, reference in zip(outputs, expected):
+                self.assertEqual(output.shape, (32, 48, 3))
+                # allow for rounding differences between batch sizes
+                self.assertLessEqual(np.abs(output - reference).max(), 1)
+        print '+ passed'
+
+    def test_ffwd_bad_checkpoint(self):
+        print '- test_ffwd_bad_checkpoint'
+        threads = threading.active_count()
+        paths_out = [self.tmp_dir + '{}.png'.format(i)
+                     for i in range(len(self.images))]
+        with self.assertRaises(Exception):
+            ffwd(self.images, paths_out, self.tmp_dir + 'missing.ckpt',
+                 device_t='/device:CPU:0', batch_size=1)
+        # no prefetch or pool threads are left behind
+        self.assertEqual(threading.active_count(), threads)
+        print '+ passed'
+
+    def test_ffwd_different_dimensions(self):
+        print '- test_ffwd_different_dimensions'
+        shapes = [(32, 48, 3), (40, 60, 3), (200, 100, 3)]
+        paths_in, paths_out = [], []
+        for i, shape in enumerate(shapes):
+            paths_in.append(self.tmp_dir + 'in_{}.png'.format(i))
+            paths_out.append(self.tmp_dir + 'out_{}.png'.format(i))
+            save_img(paths_in[-1], np.random.uniform(0, 255, shape))
+        report = ffwd_different_dimensions(paths_in, paths_out,
+                                           self.checkpoint_dir,
+                                           device_t='/device:CPU:0')
+        # the two small images share the 128x128 bucket
+        self.assertEqual(report['images'], 3)
+        self.assertEqual(report['buckets'], 2)
+        self.assertGreater(report['paddingOverhead'], 0)
+        for path_out, shape in zip(paths_out, shapes):
+            self.assertEqual(get_img(path_out).shape, shape)
+        print '+ passed'
+
+    def test_ffwd_tiled(self):
+        print '- test_ffwd_tiled'
+        # a 16MB budget gives the smallest, 128 pixel, tiles
+        self.assertEqual(tiling.tile_size_for_budget(16), 128)
+        img = np.random.uniform(0, 255, (300, 200, 3))
+        output = ffwd_tiled(img, self.checkpoint_dir, '/device:CPU:0', 16)
+        self.assertEqual(output.shape, img.shape)
+        self.assertTrue(np.isfinite(output).all())
+        # one exact tile is styled just as a whole image run would be
+        img = np.random.uniform(0, 255, (128, 128, 3)).astype(np.float32)
+        expected = get_engine().run(self.checkpoint_dir, img[np.newaxis],
+                                    '/device:CPU:0')[0]
+        np.testing.assert_allclose(
+            ffwd_tiled(img, self.checkpoint_dir, '/device:CPU:0', 16),
+            expected, rtol=1e-4, atol=1e-3)
+        print '+ passed'
+
+
+class FreezeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp() + '/'
+        self.checkpoint_dir = save_random_checkpoint(
+            self.tmp_dir + 'random.ckpt')
+        self.images = np.random.uniform(0, 255, (2, 32, 48, 3)).astype(
+            np.float32)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_frozen_matches_checkpoint(self):
+        print '- test_frozen_matches_checkpoint'
+        style_session = StyleSession(self.checkpoint_dir, '/device:CPU:0')
+        self.assertFalse(style_session.is_frozen)
+        expected = style_session.run(self.images)
+        style_session.close()
+
+        freeze.freeze(self.checkpoint_dir)
+        self.assertTrue(freeze.has_fresh_frozen(self.checkpoint_dir))
+        style_session = StyleSession(self.checkpoint_dir, '/device:CPU:0')
+        self.assertTrue(style_session.is_frozen)
+        np.testing.assert_allclose(style_session.run(self.images), expected,
+                                   rtol=1e-4, atol=1e-2)
+        style_session.close()
+        print '+ passed'
+
+
+class TilingTests(unittest.TestCase):
+
+    def test_tiling_pad(self):
+        print '- test_tiling_pad'
+        img = np.random.uniform(0, 255, (50, 70, 3))
+        padded = tiling.pad(img, (60, 90))
+        self.assertEqual(padded.shape, (60, 90, 3))
+        np.testing.assert_array_equal(padded[:50, :70], img)
+        # reflected about the last row and column
+        np.testing.assert_array_equal(padded[50:, :70], img[48:38:-1])
+        np.testing.assert_array_equal(padded[:50, 70:], img[:, 68:48:-1])
+        self.assertIs(tiling.pad(img, (40, 70)), img)
+        print '+ passed'
+
+    def test_tiling_split_blend(self):
+        print '- test_tiling_split_blend'
+        for shape in [(300, 200, 3), (128, 128, 3), (50, 70, 3)]:
+            img = np.random.randint(0, 256, shape).astype(np.float32)
+            tiles, origins = tiling.split(img, 128, overlap=32)
+            self.assertEqual(tiles.shape, (len(origins), 128, 128, 3))
+            for tile, (r, c) in zip(tiles, origins):
+                if shape[0] >= 128 and shape[1] >= 128:
+                    np.testing.assert_array_equal(
+                        tile, img[r:r + 128, c:c + 128])
+            # feathering only reweights identical values
+            np.testing.assert_allclose(
+                tiling.blend(tiles, origins, shape, overlap=32), img,
+                atol=1e-3)
+        self.assertEqual(len(tiling.split(np.zeros((300, 200, 3)), 128)[1]),
+                         6)
+        print '+ passed'
+
+    def test_tiling_budget(self):
+        print '- test_tiling_budget'
+        self.assertEqual(tiling.images_per_batch((512, 512), 1024), 4)
+        self.assertEqual(tiling.images_per_batch((1024, 1024), 1024), 1)
+        self.assertEqual(tiling.images_per_batch((2048, 2048), 1024), 0)
+        self.assertTrue(tiling.fits_budget((1024, 1024), 1024))
+        self.assertFalse(tiling.fits_budget((1024, 1024), 1024, 2))
+        self.assertEqual(tiling.tiles_per_batch(128, 1), 1)
+        print '+ passed'
+
+
+class TransformVariantTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp() + '/'
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_transform_read_config(self):
+        print '- test_transform_read_config'
+        for variant, config in transform.VARIANTS.items():
+            checkpoint_dir = save_random_checkpoint(
+                self.tmp_dir + variant + '.ckpt', **config)
+            self.assertEqual(transform.read_config(checkpoint_dir), config)
+        print '+ passed'
+
+    def test_transform_count_flops(self):
+        print '- test_transform_count_flops'
+        full = transform.count_flops(512, 512, **transform.VARIANTS['full'])
+        lite = transform.count_flops(512, 512, **transform.VARIANTS['lite'])
+        self.assertLess(lite * 4, full)
+        self.assertEqual(transform.count_flops(1024, 1024), full * 4)
+        print '+ passed'
+
+
+class OptimizeBatchesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp() + '/'
+        self.paths = []
+        for i in range(6):
+            self.paths.append(self.tmp_dir + '{}.png'.format(i))
+            save_img(self.paths[-1], np.random.uniform(0, 255, (40, 60, 3)))
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_optimize_batches(self):
+        print '- test_optimize_batches'
+        inline = list(optimize._batches(self.paths, 2))
+        prefetched = list(optimize._batches(
+            self.paths, 2, multiprocessing.Pool(2), depth=1))
+        self.assertEqual(len(prefetched), 3)
+        for batch, expected in zip(prefetched, inline):
+            self.assertEqual(batch.shape, (2,) + optimize.CONTENT_SHAPE)
+            self.assertEqual(batch.dtype, np.float32)
+            np.testing.assert_array_equal(batch, expected)
+        print '+ passed'
+
+
+class ContentShardsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp() + '/'
+        self.paths = []
+        for i in range(7):
+            self.paths.append(self.tmp_dir + '{}.png'.format(i))
+            save_img(self.paths[-1], np.random.uniform(0, 255, (40, 60, 3)))
+        shards.write_shards(self.paths, self.tmp_dir + 'shards',
+                            shard_images=3, processes=2)
+        self.content = shards.ContentShards(self.tmp_dir + 'shards')
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_content_shards_get(self):
+        print '- test_content_shards_get'
+        self.assertEqual(len(self.content), 7)
+        self.assertEqual(len(self.content.shards), 3)
+        batch = self.content.get([6, 0, 4])
+        self.assertEqual(batch.dtype, np.float32)
+        for img, path in zip(batch, [self.paths[6], self.paths[0],
+                                     self.paths[4]]):
+            np.testing.assert_array_equal(img, optimize._load_content(path))
+        print '+ passed'
+
+    def test_content_shards_batches(self):
+        print '- test_content_shards_batches'
+        batches = list(self.content.batches(3, epochs=2, seed=0))
+        # the seventh image does not fill a batch and is dropped each epoch
+        self.assertEqual(len(batches), 4)
+        full = self.content.get(range(7))
+        for epoch in (batches[:2], batches[2:]):
+            seen = []
+            for batch in epoch:
+                self.assertEqual(batch.shape, (3,) + shards.CONTENT_SHAPE)
+                for img in batch:
+                    seen.append(next(i for i in range(7)
+                                     if (full[i] == img).all()))
+            self.assertEqual(len(set(seen)), 6)
+        print '+ passed'
+
+    def test_content_shards_features(self):
+        print '- test_content_shards_features'
+
+        def compute(X):
+            return X[:, ::8, ::8, :2] / 3.0
+
+        self.assertFalse(self.content.has_features('test'))
+        self.content.write_features('test', compute, batch_size=2)
+        self.assertTrue(self.content.has_features('test'))
+        self.assertEqual(self.content.load_features('test'), (32, 32, 2))
+        for X, features in self.content.batches(3, with_features=True):
+            # stored as float16
+            np.testing.assert_allclose(features, compute(X), rtol=1e-3)
+        print '+ passed'
+
+
+class VggTests(unittest.TestCase):
+
+    def setUp(self):
+        # random weights in a small MatConvNet-layout .mat stand in for
+        # imagenet-vgg-verydeep-19.mat
+        self.tmp_dir = mkdtemp() + '/'
+        self.data_path = self.tmp_dir + 'vgg.mat'
+        self.weights = self.write_mat(0)
+
+    def tearDown(self):
+        vgg._weights.pop(self.data_path, None)
+        rmtree(self.tmp_dir)
+
+    def write_mat(self, seed):
+        """Write the .mat, return the kernels and biases as saved"""
+        random = np.random.RandomState(seed)
+        layers = np.empty((1, len(vgg.LAYERS)), dtype=object)
+        weights, in_channels = {}, 3
+        for i, name in enumerate(vgg.LAYERS):
+            layer = np.zeros((1, 1), dtype=[('weights', object)])
+            if name.startswith('conv'):
+                out_channels = 4
+                # matconvnet kernels are [width, height, in, out]
+                kernels = random.normal(0, 0.5, (3, 3, in_channels,
+                                                 out_channels))
+                bias = random.normal(0, 0.1, (1, out_channels))
+                layer[0, 0]['weights'] = np.empty((1, 2), dtype=object)
+                layer[0, 0]['weights'][0, 0] = kernels.astype(np.float32)
+                layer[0, 0]['weights'][0, 1] = bias.astype(np.float32)
+                weights[name] = (kernels.astype(np.float32),
+                                 bias.astype(np.float32))
+                in_channels = out_channels
+            else:
+                layer[0, 0]['weights'] = np.zeros((0, 0))
+            layers[0, i] = layer
+        savemat(self.data_path, {'layers': layers})
+        return weights
+
+    def assert_weights(self, loaded, weights):
+        for name, (kernels, bias) in weights.items():
+            np.testing.assert_array_equal(
+                loaded[name][0], np.transpose(kernels, (1, 0, 2, 3)))
+            np.testing.assert_array_equal(loaded[name][1], bias.reshape(-1))
+
+    def test_vgg_load_weights(self):
+        print '- test_vgg_load_weights'
+        loaded = vgg.load_weights(self.data_path)
+        self.assertTrue(os.path.isdir(self.data_path + vgg.WEIGHTS_SUFFIX))
+        self.assertIsInstance(loaded['conv1_1'][0], np.memmap)
+        self.assert_weights(loaded, self.weights)
+        self.assertIs(vgg.load_weights(self.data_path), loaded)
+        print '+ passed'
+
+    def test_vgg_load_weights_cached(self):
+        print '- test_vgg_load_weights_cached'
+        vgg.load_weights(self.data_path)
+        # another process only maps the converted arrays
+        del vgg._weights[self.data_path]
+        with patch.object(vgg.scipy.io, 'loadmat',
+                          side_effect=AssertionError('.mat was read')):
+            self.assert_weights(vgg.load_weights(self.data_path),
+                                self.weights)
+        print '+ passed'
+
+    def test_vgg_load_weights_reconverts(self):
+        print '- test_vgg_load_weights_reconverts'
+        vgg.load_weights(self.data_path)
+        del vgg._weights[self.data_path]
+        weights = self.write_mat(1)
+        newer = os.path.getmtime(self.data_path + vgg.WEIGHTS_SUFFIX) + 10
+        os.utime(self.data_path, (newer, newer))
+        self.assert_weights(vgg.load_weights(self.data_path), weights)
+        print '+ passed'
+
+    def test_vgg_net_truncated(self):
+        print '- test_vgg_net_truncated'
+        X = np.random.uniform(0, 255, (2, 32, 32, 3)).astype(np.float32)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            image = tf.constant(X)
+            full = vgg.net(self.data_path, image)
+            head = vgg.net(self.data_path, image, last_layer='relu4_2')
+            tail = vgg.net(self.data_path, head['relu4_2'],
+                           last_layer='relu5_1', after_layer='relu4_2')
+            self.assertEqual(len(full), len(vgg.LAYERS))
+            self.assertNotIn('conv4_3', head)
+            self.assertEqual(sorted(tail), sorted(['conv4_3', 'relu4_3',
+                                                   'conv4_4', 'relu4_4',
+                                                   'pool4', 'conv5_1',
+                                                   'relu5_1']))
+            expected, result = sess.run([full['relu5_1'], tail['relu5_1']])
+            np.testing.assert_allclose(result, expected, rtol=1e-4,
+                                       atol=1e-4)
+        print '+ passed'
+
+    def test_vgg_net_shared_batch(self):
+        print '- test_vgg_net_shared_batch'
+        X = np.random.uniform(0, 255, (4, 32, 32, 3)).astype(np.float32)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            shared = vgg.net(self.data_path, tf.constant(X),
+                             last_layer='relu4_2')
+            content = vgg.net(self.data_path, tf.constant(X[:2]),
+                              last_layer='relu4_2')
+            preds = vgg.net(self.data_path, tf.constant(X[2:]),
+                            last_layer='relu4_2')
+            result, expected_content, expected_preds = sess.run(
+                [shared['relu4_2'], content['relu4_2'], preds['relu4_2']])
+        np.testing.assert_allclose(result[:2], expected_content, rtol=1e-4,
+                                   atol=1e-4)
+        np.testing.assert_allclose(result[2:], expected_preds, rtol=1e-4,
+                                   atol=1e-4)
+        print '+ passed'
+
+
 # ========================================================================== #
 # Helper Functions
 
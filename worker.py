@@ -0,0 +1,124 @@
+"""Style job worker for deep-paint
+
+Pulls queued StyleJobs from the database and runs them through tensorflow,
+keeping inference out of the Flask request cycle. Run any number of these
+next to server.py:
+
+    $ python worker.py
+
+Each worker runs several jobs at once so that concurrent requests for the
+same style can share a batched sess.run (see fast_style_transfer/scheduler).
+Jobs waiting on a preview are taken before any other, so a preview waits at
+most for one of the worker's threads to free up.
+Set DEEP_PAINT_WORKER_METRICS_PORT to expose the worker's per-stage timings
+on http://localhost:<port>/metrics.
+
+Before taking jobs the worker warms up: the most used styles that fit in
+DEEP_PAINT_WARM_UP_MB are restored and run once at the preview and full
+sizes, so no user pays for a cold style after a deploy. Only then does
+http://localhost:<port>/ready answer 200 and, if DEEP_PAINT_WORKER_READY_FILE
+is set, the ready file get written.
+"""
+
+from fast_style_transfer import metrics
+from fast_style_transfer.backend import get_backend
+from fast_style_transfer.engine import get_engine, within_budget
+from fast_style_transfer.pool import get_pool
+from flask import Flask
+from model import (Style, StyleJob, BASEPATH, MAX_IMAGE_EDGE, PREVIEW_EDGE,
+                   connect_to_db)
+from threading import Event, Thread
+from time import sleep, time
+import atexit
+import os
+
+POLL_INTERVAL = 0.5
+WORKER_THREADS = int(os.environ.get('DEEP_PAINT_WORKER_THREADS', 4))
+METRICS_PORT = int(os.environ.get('DEEP_PAINT_WORKER_METRICS_PORT', 0))
+READY_FILE = os.environ.get('DEEP_PAINT_WORKER_READY_FILE')
+WARM_UP_MEMORY_MB = float(os.environ.get('DEEP_PAINT_WARM_UP_MB', 256))
+WARM_UP_SIZES = (PREVIEW_EDGE, MAX_IMAGE_EDGE)
+# the device StyledImage renders on, see evaluate.ffwd_bytes
+WARM_UP_DEVICE = '/device:CPU:0'
+
+
+def warm_up(max_memory_mb=WARM_UP_MEMORY_MB, sizes=WARM_UP_SIZES):
+    """Preload the most used styles and run a dummy pass at each size
+
+    Returns the checkpoints that were warmed.
+    """
+
+    checkpoint_dirs = [BASEPATH + style.get_path(variant)
+                       for style in Style.get_most_used()
+                       for variant in style.get_variants()]
+    checkpoint_dirs = within_budget(
+        [checkpoint_dir for checkpoint_dir in checkpoint_dirs
+         if os.path.exists(checkpoint_dir)], max_memory_mb)
+
+    start_time = time()
+    # pool processes warm themselves as they start
+    inference_pool = get_pool((checkpoint_dirs, sizes, WARM_UP_DEVICE))
+    if inference_pool is not None:
+        inference_pool.wait_ready()
+    else:
+        checkpoint_dirs = get_engine().warm_up(checkpoint_dirs, sizes,
+                                               WARM_UP_DEVICE)
+    print '-----> warmed {n} styles in {secs:.2f}s'.format(
+        n=len(checkpoint_dirs), secs=time() - start_time)
+    return checkpoint_dirs
+
+
+def mark_ready(ready):
+    """Report the worker as ready to take traffic"""
+
+    ready.set()
+    if READY_FILE:
+        with open(READY_FILE, 'w') as f:
+            f.write(str(os.getpid()))
+        atexit.register(remove_ready_file)
+
+
+def remove_ready_file():
+    if READY_FILE and os.path.isfile(READY_FILE):
+        os.remove(READY_FILE)
+
+
+def work(poll_interval=POLL_INTERVAL, run_once=False):
+    """Process queued style jobs until interrupted"""
+
+    while True:
+        style_job = StyleJob.claim_next()
+        if style_job is None:
+            if run_once:
+                return
+            sleep(poll_interval)
+            continue
+
+        start_time = time()
+        style_job.run()
+        print '-----> {job} finished in {secs:.2f}s'.format(
+            job=style_job, secs=time() - start_time)
+
+
+def work_concurrently(threads=WORKER_THREADS, poll_interval=POLL_INTERVAL):
+    """Run work() on several threads sharing the process' style sessions"""
+
+    workers = [Thread(target=work, args=(poll_interval,))
+               for _ in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    while any(worker.is_alive() for worker in workers):
+        sleep(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    app = Flask(__name__)
+    connect_to_db(app)
+    ready = Event()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT, ready=ready)
+    get_backend().module  # import tensorflow now rather than on first job
+    warm_up()
+    mark_ready(ready)
+    work_concurrently()